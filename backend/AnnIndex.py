@@ -0,0 +1,149 @@
+import logging
+import numpy as np
+import os
+
+logger = logging.getLogger()
+
+N_PROBE = 8
+KMEANS_ITERATIONS = 10
+MIN_TRAIN_SIZE = 1024 # below this many embeddings the index stays one list, that is exact search
+RETRAIN_GROWTH = 4 # retrain when the index grows this many times since last training
+
+class IVFIndex:
+    '''
+    Inverted file index for normed embeddings. Embeddings are grouped into lists by their closest centroid
+    (spherical k-means), a search only scores the lists whose centroids are closest to the query.
+    Only the centroids are persisted, the lists are filled again from the database when it is loaded.
+    '''
+    def __init__(self, dim = 512, n_probe = N_PROBE):
+        self.dim = dim
+        self.n_probe = n_probe
+        self.centroids = None
+        self.trained_size = 0
+        self.clear()
+
+    def clear(self):
+        # keep the centroids, drop all embeddings
+        n_lists = 1 if self.centroids is None else len(self.centroids)
+        self.list_vectors = [np.zeros((0, self.dim), dtype=np.float32) for _ in range(n_lists)]
+        self.list_labels = [np.zeros((0,), dtype=np.int32) for _ in range(n_lists)]
+
+    def size(self):
+        return sum([len(labels) for labels in self.list_labels])
+
+    def is_trained(self):
+        return self.centroids is not None
+
+    def needs_training(self, size):
+        if size < MIN_TRAIN_SIZE:
+            return False
+        return not self.is_trained() or size > self.trained_size * RETRAIN_GROWTH
+
+    def train(self, vectors, n_lists = None, iterations = KMEANS_ITERATIONS, seed = 0):
+        '''
+        Cluster the vectors with spherical k-means, the embeddings already in the index are moved to the new lists.
+        n_lists: number of lists, sqrt of the number of vectors if not set
+        '''
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if n_lists is None:
+            n_lists = int(np.sqrt(len(vectors)))
+        n_lists = max(1, min(n_lists, len(vectors)))
+        rng = np.random.default_rng(seed)
+        centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+        for _ in range(iterations):
+            assign = np.argmax(np.dot(vectors, centroids.T), axis=1)
+            order = np.argsort(assign, kind='stable')
+            counts = np.bincount(assign, minlength=n_lists)
+            non_empty = np.flatnonzero(counts)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+            sums = vectors[rng.choice(len(vectors), n_lists)] # empty lists get a random vector
+            sums[non_empty] = np.add.reduceat(vectors[order], starts, axis=0)
+            centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+
+        old_vectors = np.concatenate(self.list_vectors, axis=0)
+        old_labels = np.concatenate(self.list_labels, axis=0)
+        self.centroids = centroids.astype(np.float32)
+        self.trained_size = len(vectors)
+        self.clear()
+        self.add(old_vectors, old_labels)
+        logger.info(f'IVFIndex trained with {len(vectors)} embeddings into {n_lists} lists')
+
+    def add(self, vectors, labels):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        labels = np.broadcast_to(np.asarray(labels, dtype=np.int32), (len(vectors),))
+        if len(vectors) == 0:
+            return
+        if self.is_trained():
+            assign = np.argmax(np.dot(vectors, self.centroids.T), axis=1)
+        else:
+            assign = np.zeros((len(vectors),), dtype=np.int64)
+        for i in np.unique(assign):
+            mask = assign == i
+            self.list_vectors[i] = np.concatenate([self.list_vectors[i], vectors[mask]], axis=0)
+            self.list_labels[i] = np.concatenate([self.list_labels[i], labels[mask]], axis=0)
+
+    def remove_label(self, label):
+        for i in range(len(self.list_labels)):
+            keep = self.list_labels[i] != label
+            if not np.all(keep):
+                self.list_vectors[i] = self.list_vectors[i][keep]
+                self.list_labels[i] = self.list_labels[i][keep]
+
+    def search(self, queries, n_probe = None):
+        '''
+        input:
+        queries: (N, dim) normed embeddings
+        n_probe: number of closest lists to score, self.n_probe if not set
+
+        output:
+        labels: (N,) label of the most similar embedding of each query, -1 if nothing found
+        scores: (N,) similarity score of it
+        '''
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        best_labels = np.full((len(queries),), -1, dtype=np.int32)
+        best_scores = np.full((len(queries),), -np.inf, dtype=np.float32)
+        if self.is_trained():
+            n_probe = min(self.n_probe if n_probe is None else n_probe, len(self.centroids))
+            probes = np.argpartition(-np.dot(queries, self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            probes = np.zeros((len(queries), 1), dtype=np.int64)
+
+        for q in range(len(queries)):
+            for i in probes[q]:
+                if len(self.list_labels[i]) == 0:
+                    continue
+                scores = np.dot(self.list_vectors[i], queries[q])
+                best = np.argmax(scores)
+                if scores[best] > best_scores[q]:
+                    best_scores[q] = scores[best]
+                    best_labels[q] = self.list_labels[i][best]
+        return best_labels, best_scores
+
+    def save(self, path):
+        if not self.is_trained():
+            return
+        np.savez(path, centroids=self.centroids, trained_size=self.trained_size)
+        logger.debug(f'Save IVFIndex centroids to {path}')
+
+    def load(self, path):
+        '''
+        Load centroids saved by save(), the index is cleared.
+        output: bool - whether loaded
+        '''
+        if not os.path.exists(path):
+            return False
+        try:
+            data = np.load(path)
+            centroids = data['centroids']
+            trained_size = int(data['trained_size'])
+        except Exception as e:
+            logger.warning(f'Failed to load IVFIndex from {path}, error: {e}')
+            return False
+        if centroids.ndim != 2 or centroids.shape[1] != self.dim:
+            logger.warning(f'IVFIndex in {path} does not match dimension {self.dim}')
+            return False
+        self.centroids = centroids.astype(np.float32)
+        self.trained_size = trained_size
+        self.clear()
+        logger.debug(f'Load IVFIndex centroids from {path}')
+        return True
@@ -0,0 +1,228 @@
+import glob
+import json
+import logging
+import os
+import numpy as np
+
+logger = logging.getLogger()
+
+STORE_INDEX_FILE = '.embeddings_index.jsonl' # dot files, not listed as members of database
+STORE_DATA_FILE = '.embeddings_{}.f32'
+COMPACT_DEAD_RATIO = 0.5 # compact when this ratio of rows are removed
+
+class EmbeddingStore:
+    '''
+    All embeddings of a database in one memory-mapped float32 matrix, with an index of the member and image of each row.
+    Writes only append: new rows are appended to the matrix file, and every change is a line appended to the index log.
+    The matrix file is never truncated, it may be mapped by this or other processes (Windows refuses to resize a mapped file).
+    Removed rows stay in the matrix until compact() rewrites it into a new file, so readers of the old file are not affected.
+    '''
+    def __init__(self, root, dim = 512):
+        self.root = root
+        self.dim = dim
+        self.index_path = os.path.join(root, STORE_INDEX_FILE)
+        self._reset()
+
+    def _reset(self):
+        self.generation = 0
+        self.data_path = None
+        self.matrix = np.zeros((0, self.dim), dtype=np.float32)
+        self.row_names = []
+        self.row_images = []
+        self.alive = []
+        self.name_rows = {}
+        self.index_valid_size = None # size of the index without an incomplete last line, cut before next write
+
+    def exists(self):
+        return os.path.exists(self.index_path)
+
+    def load(self):
+        '''
+        Replay the index log and map the matrix file read-only.
+        output: bool - whether the store exists and is loaded
+        '''
+        self._reset()
+        if not self.exists():
+            return False
+        try:
+            with open(self.index_path, 'rb') as f:
+                header = json.loads(f.readline())
+                valid_size = f.tell()
+                for line in f:
+                    try:
+                        entry = json.loads(line) if line.strip() else None
+                        if not line.endswith(b'\n'):
+                            raise ValueError('no line end')
+                    except ValueError:
+                        logger.warning('Incomplete line in embedding index, ignore the rest')
+                        self.index_valid_size = valid_size
+                        break
+                    valid_size += len(line)
+                    if entry is not None:
+                        self._apply(entry)
+            if header['dim'] != self.dim:
+                raise ValueError(f'dimension {header["dim"]} does not match {self.dim}')
+            self.generation = header['generation']
+            self.data_path = os.path.join(self.root, STORE_DATA_FILE.format(self.generation))
+            self._map()
+        except Exception as e:
+            logger.warning(f'Failed to load embedding store, error: {e}')
+            self._reset()
+            return False
+        logger.debug(f'Load embedding store: {len(self.row_names)} rows, {self.dead_count()} removed')
+        return True
+
+    def get_names(self):
+        '''
+        output: set of member names having rows not removed
+        '''
+        return set([name for name, rows in self.name_rows.items() if len(rows) > 0])
+
+    def get_rows(self):
+        '''
+        output:
+        matrix: (N, dim) float32 embeddings not removed, the memory map itself if no row is removed
+        names: list of member name of each row
+        images: list of image id of each row
+        '''
+        if self.dead_count() == 0:
+            return self.matrix, list(self.row_names), list(self.row_images)
+        alive = np.array(self.alive, dtype=bool)
+        rows = np.flatnonzero(alive)
+        return self.matrix[alive], [self.row_names[i] for i in rows], [self.row_images[i] for i in rows]
+
+    def get_member(self, name):
+        '''
+        output: (N, dim) embeddings and list of image ids of the member, None if not in store
+        '''
+        if name not in self.name_rows:
+            return None, []
+        rows = self.name_rows[name]
+        return self.matrix[rows], [self.row_images[i] for i in rows]
+
+    def append(self, name, embeddings, image_ids = None):
+        embeddings = np.ascontiguousarray(np.reshape(embeddings, (-1, self.dim)), dtype=np.float32)
+        if len(embeddings) == 0:
+            return
+        if image_ids is None:
+            image_ids = [''] * len(embeddings)
+        self._ensure_loaded()
+        if self.data_path is None:
+            self._create()
+        # rows written before an interrupted index write are skipped, the new rows start at the next whole row
+        row_bytes = self.dim * 4
+        size = os.path.getsize(self.data_path)
+        start = -(-size // row_bytes)
+        with open(self.data_path, 'ab') as f:
+            f.write(bytes(start * row_bytes - size))
+            f.write(embeddings.tobytes())
+        self._log({'op': 'add', 'name': name, 'images': list(image_ids), 'row': start})
+        self._map()
+
+    def remove(self, name):
+        self._ensure_loaded()
+        if name not in self.name_rows:
+            return
+        self._log({'op': 'remove', 'name': name})
+
+    def rename(self, old_name, new_name):
+        self._ensure_loaded()
+        if old_name not in self.name_rows:
+            return
+        self._log({'op': 'rename', 'name': old_name, 'to': new_name})
+
+    def replace(self, name, embeddings, image_ids = None):
+        self.remove(name)
+        self.append(name, embeddings, image_ids)
+
+    def dead_count(self):
+        return len(self.alive) - sum(self.alive)
+
+    def compact_if_needed(self):
+        dead = self.dead_count()
+        if dead > 0 and dead >= len(self.alive) * COMPACT_DEAD_RATIO:
+            self.compact()
+
+    def compact(self):
+        '''
+        Rewrite the rows not removed into a new matrix file, rows of a member are put together.
+        The index is switched to the new file at once, the old file is deleted if no one maps it.
+        '''
+        generation = self.generation + 1
+        data_path = os.path.join(self.root, STORE_DATA_FILE.format(generation))
+        entries = []
+        rows = []
+        for name, name_rows in self.name_rows.items():
+            if len(name_rows) == 0:
+                continue
+            entries.append({'op': 'add', 'name': name, 'images': [self.row_images[i] for i in name_rows], 'row': len(rows)})
+            rows.extend(name_rows)
+        self.matrix[rows].astype(np.float32).tofile(data_path)
+        with open(self.index_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'dim': self.dim, 'generation': generation}) + '\n')
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(self.index_path + '.tmp', self.index_path)
+        logger.info(f'Compact embedding store: {len(self.alive)} rows to {len(rows)}')
+        self.load()
+        # files of older generations may still be mapped by other processes, they are removed by a later compaction
+        for path in glob.glob(os.path.join(self.root, STORE_DATA_FILE.format('*'))):
+            if path == self.data_path:
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.debug(f'Old embedding store file is still in use: {e}')
+
+    def _ensure_loaded(self):
+        # rows are appended after the rows in index, so the index must be read before any write
+        if self.data_path is None and self.exists():
+            self.load()
+
+    def _create(self):
+        self._reset()
+        self.data_path = os.path.join(self.root, STORE_DATA_FILE.format(self.generation))
+        open(self.data_path, 'wb').close()
+        with open(self.index_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'dim': self.dim, 'generation': self.generation}) + '\n')
+        logger.info(f'Create embedding store in {self.root}')
+
+    def _map(self):
+        rows = len(self.row_names)
+        if rows == 0:
+            self.matrix = np.zeros((0, self.dim), dtype=np.float32)
+        else:
+            self.matrix = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(rows, self.dim))
+
+    def _log(self, entry):
+        if self.index_valid_size is not None:
+            with open(self.index_path, 'r+b') as f:
+                f.truncate(self.index_valid_size)
+            self.index_valid_size = None
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._apply(entry)
+
+    def _apply(self, entry):
+        name = entry['name']
+        if entry['op'] == 'add':
+            start = entry.get('row', len(self.row_names))
+            if start < len(self.row_names):
+                raise ValueError(f'rows of "{name}" overlap earlier rows')
+            # rows skipped after an interrupted write are removed rows without a member
+            gap = start - len(self.row_names)
+            self.row_names.extend([None] * gap)
+            self.row_images.extend([''] * gap)
+            self.alive.extend([False] * gap)
+            self.row_names.extend([name] * len(entry['images']))
+            self.row_images.extend(entry['images'])
+            self.alive.extend([True] * len(entry['images']))
+            self.name_rows.setdefault(name, []).extend(range(start, len(self.row_names)))
+        elif entry['op'] == 'remove':
+            for row in self.name_rows.pop(name, []):
+                self.alive[row] = False
+        elif entry['op'] == 'rename':
+            rows = self.name_rows.pop(name, [])
+            for row in rows:
+                self.row_names[row] = entry['to']
+            self.name_rows.setdefault(entry['to'], []).extend(rows)
@@ -4,12 +4,26 @@ import shutil
 import glob
 import cv2
 import logging
+from collections import ChainMap
 
 logger = logging.getLogger()
 
+EMBEDDING_DIM = 512
+MIN_MATRIX_CAPACITY = 64
+ANN_INDEX_FILE = '.ann_index.npz' # dot file, not listed as a member of database
+EMBEDDING_MANIFEST_FILE = '.embedding_manifest.npz' # content hash of each database image and its embedding, with the recognizer settings
+
 class FaceDatabaseManager:
-    def __init__(self, root, face_recognizer = None, new_member_prefix = 'new_member_'):
+    def __init__(self, root, face_recognizer = None, new_member_prefix = 'new_member_', ann_index = None, embedding_store = None):
+        '''
+        ann_index: optional approximate nearest neighbour index (e.g. IVFIndex) used for searching large databases
+        embedding_store: optional store (e.g. EmbeddingStore) keeping all embeddings of the database in one memory-mapped file,
+                         without it embeddings are kept in embeddings.npy of each member
+        '''
         self.database_root = root
+        self.ann_index = ann_index
+        self.embedding_store = embedding_store
+        self.pending_embeddings = [] # (name, embedding, image id) added in this session, not in embedding_store yet
         self.face_recognizer = face_recognizer
         if face_recognizer is not None:
             self.have_face_recognizer = True
@@ -17,6 +31,7 @@ class FaceDatabaseManager:
             self.have_face_recognizer = False
         self.new_member_prefix = new_member_prefix
         logger.debug(f'new member prefix set to "{new_member_prefix}"')
+        self._reset_embedding_matrix()
         
         if not os.path.exists(self.database_root):
             os.mkdir(self.database_root)
@@ -45,32 +60,50 @@ class FaceDatabaseManager:
         '''
         unprocessed_names = []
         self.name_embeddings_dict = {}
+        self.pending_embeddings = []
+        
+        if self.embedding_store is not None and not self.embedding_store.load():
+            self._load_names()
+            self._migrate_to_store()
         
         if generate_all:
             self.generate_database_embeddings()
         
         self._load_names()
-        for name in self.names:
-            embaddings_path = os.path.join(self.database_root, name, 'embeddings.npy')
-            if not os.path.exists(embaddings_path):
-                unprocessed_names.append(name)
-                continue
-            
-            # load embeddings
-            try:
-                embaddings = np.load(embaddings_path, allow_pickle=True)
-            except Exception as e:
-                logger.warning(f'Failed to load embeddings for {name}, error: {e}')
-                unprocessed_names.append(name)
-                continue
-            
-            self.name_embeddings_dict[name] = embaddings
+        if self.embedding_store is not None:
+            self._reset_embedding_matrix() # drop the map of the store, so compaction can delete the old file
+            self.embedding_store.compact_if_needed()
+            stored_names = self.embedding_store.get_names()
+            unprocessed_names = [name for name in self.names if name not in stored_names]
+        else:
+            for name in self.names:
+                embaddings_path = os.path.join(self.database_root, name, 'embeddings.npy')
+                if not os.path.exists(embaddings_path):
+                    unprocessed_names.append(name)
+                    continue
+                
+                # load embeddings
+                try:
+                    embaddings = np.load(embaddings_path, allow_pickle=True)
+                except Exception as e:
+                    logger.warning(f'Failed to load embeddings for {name}, error: {e}')
+                    unprocessed_names.append(name)
+                    continue
+                
+                self.name_embeddings_dict[name] = embaddings
             
         if len(unprocessed_names) > 0 and retry:
             logger.info(f'Try to generate embeddings for: {unprocessed_names}')
             self.generate_database_embeddings(unprocessed_names)
             self.load_data(retry = False)
         else:
+            self._reset_embedding_matrix()
+            if self.embedding_store is not None:
+                self._load_matrix_from_store()
+            else:
+                for name, embaddings in self.name_embeddings_dict.items():
+                    self._append_to_matrix(name, embaddings)
+            self._build_ann_index()
             logger.info('Load data finished')
    
     def get_name_list(self):
@@ -96,9 +129,23 @@ class FaceDatabaseManager:
     def get_name_embeddings_dict(self):
         return self.name_embeddings_dict
     
+    def get_embedding_matrix(self):
+        '''
+        output:
+        matrix: (N, 512) float32, all embeddings in the database
+        labels: (N,) int, label of each row
+        label_names: list, name of each label (None if deleted)
+        '''
+        count = self.embedding_count
+        return self.embedding_matrix[:count], self.embedding_labels[:count], self.label_names
+    
+    def get_ann_index(self):
+        return self.ann_index
+    
     def generate_database_embeddings(self, names_to_process = None):
         '''
-        Generate embeddings files for faces in the database, if not assign names_to_process, generate all
+        Generate embeddings files for faces in the database, if not assign names_to_process, generate all.
+        Only images added or changed since last time are processed, the others reuse their embeddings in the manifest.
         '''
         if not self.have_face_recognizer:
             logger.warning('FaceRecognizer is not set!')
@@ -107,14 +154,7 @@ class FaceDatabaseManager:
         self._load_names()
         
         if names_to_process is None: # generate all
-            for name in self.names:
-                folder_path = os.path.join(self.database_root, name)
-                embaddings_path = os.path.join(folder_path, 'embeddings.npy')
-                stack = self.face_recognizer.generate_embeddings_from_folder(folder_path)
-                if stack is None:
-                    continue
-                np.save(embaddings_path, stack)
-                logger.debug(f'Generate embeddings for "{name}"')
+            namesToProcess = self.names
         else:
             namesToProcess = []
             for name in names_to_process:
@@ -123,14 +163,17 @@ class FaceDatabaseManager:
                     continue
                 namesToProcess.append(name)
 
-            for name in namesToProcess:
-                folder_path = os.path.join(self.database_root, name)
-                embaddings_path = os.path.join(folder_path, 'embeddings.npy')
-                stack = self.face_recognizer.generate_embeddings_from_folder(folder_path)
-                if stack is None:
-                    continue
-                np.save(embaddings_path, stack)
-                logger.debug(f'Generate embeddings for "{name}"')
+        # images seen this time are written to the first map, so a full generation drops removed images from manifest
+        manifest = ChainMap({}, self._load_manifest())
+        for name in namesToProcess:
+            folder_path = os.path.join(self.database_root, name)
+            image_ids = []
+            stack = self.face_recognizer.generate_embeddings_from_folder(folder_path, manifest, image_ids)
+            if stack is None:
+                continue
+            self._save_member_embeddings(name, stack, image_ids)
+            logger.debug(f'Generate embeddings for "{name}"')
+        self._save_manifest(manifest.maps[0] if names_to_process is None else dict(manifest))
         logger.info('Generate embeddings finished')
 
     def add_new_face(self, image = None, name = None, embedding = None):
@@ -144,18 +187,20 @@ class FaceDatabaseManager:
             os.makedirs(os.path.join(self.database_root, name))
             logger.debug(f'Create new folder for {name}')
             
+        image_id = ''
         if image is not None:
             id = 0
             while os.path.exists(os.path.join(self.database_root, name, f'{id}.png')):
                 id += 1
-            cv2.imwrite(os.path.join(self.database_root, name, f'{id}.png'), image)
+            image_id = f'{id}.png'
+            cv2.imwrite(os.path.join(self.database_root, name, image_id), image)
             logger.info(f'Add new face image for {name}')
         if embedding is not None:
-            self.add_embedding(name, embedding)
+            self.add_embedding(name, embedding, image_id)
         
         return name
     
-    def add_embedding(self, name, embedding):
+    def add_embedding(self, name, embedding, image_id = ''):
         if embedding is None:
             return
         
@@ -167,6 +212,8 @@ class FaceDatabaseManager:
             self.name_embeddings_dict[name] = np.reshape(embedding, (1, 512))
         else:
             self.name_embeddings_dict[name] = np.append(self.name_embeddings_dict[name], np.reshape(embedding, (1, 512)), axis = 0)
+        self.pending_embeddings.append((name, np.reshape(embedding, (1, 512)), image_id))
+        self._append_to_matrix(name, embedding)
         logger.debug(f'Add embedding for "{name}"')
     
     def smart_merge_faces(self, threshold = 0.3):
@@ -206,6 +253,20 @@ class FaceDatabaseManager:
                     self.rename_face(not_merged_names[i], not_merged_names[j])
                 
     def store_embeddings(self):
+        '''
+        Save embeddings added in this session. With embedding_store, they are appended to the store.
+        '''
+        if self.embedding_store is not None:
+            if len(self.pending_embeddings) == 0:
+                logger.warning('No embeddings to store')
+                return
+            for name, embedding, image_id in self.pending_embeddings:
+                self.embedding_store.append(name, embedding, [image_id])
+            logger.info(f'Store {len(self.pending_embeddings)} embeddings finished')
+            self.pending_embeddings = []
+            self.embedding_store.compact_if_needed()
+            return
+        
         if self.name_embeddings_dict is None or len(self.name_embeddings_dict) == 0:
             logger.warning('No embeddings to store')
             return
@@ -252,26 +313,41 @@ class FaceDatabaseManager:
                 
             shutil.rmtree(os.path.join(self.database_root, old_name))
             logger.debug(f'Delete {old_name}')
+            self._remove_member_embeddings(old_name)
             if self.face_recognizer is not None:
                 folder_path = os.path.join(self.database_root, new_name)
-                embaddings_path = os.path.join(folder_path, 'embeddings.npy')
-                stack = self.face_recognizer.generate_embeddings_from_folder(folder_path)
+                manifest = self._load_manifest()
+                image_ids = []
+                stack = self.face_recognizer.generate_embeddings_from_folder(folder_path, manifest, image_ids)
+                self._save_manifest(manifest)
                 if stack is None:
                     logger.warning(f'Failed to generate embeddings for {new_name}')
                     return
                 else:
-                    np.save(embaddings_path, stack)
+                    self._save_member_embeddings(new_name, stack, image_ids)
+                    self.pending_embeddings = [pending for pending in self.pending_embeddings if pending[0] != new_name]
                     self.name_embeddings_dict[new_name] = stack
                     self.name_embeddings_dict.pop(old_name)
+                    self._remove_from_matrix(old_name)
+                    self._remove_from_matrix(new_name)
+                    self._append_to_matrix(new_name, stack)
                     logger.debug(f'Generate embeddings for "{new_name}"')
             else:
                 logger.warning('FaceRecognizer is not set, changes will not be reflected in embeddings')
         else:
             os.rename(os.path.join(self.database_root, old_name), os.path.join(self.database_root, new_name))
             logger.info(f'{old_name} renamed to {new_name}')
+            if self.embedding_store is not None:
+                self.embedding_store.rename(old_name, new_name)
+            self.pending_embeddings = [(new_name if pending_name == old_name else pending_name, embedding, image_id)
+                                       for pending_name, embedding, image_id in self.pending_embeddings]
             if old_name in self.name_embeddings_dict.keys():
                 self.name_embeddings_dict[new_name] = self.name_embeddings_dict[old_name]
                 self.name_embeddings_dict.pop(old_name)
+            if old_name in self.name_labels:
+                label = self.name_labels.pop(old_name)
+                self.name_labels[new_name] = label
+                self.label_names[label] = new_name
                 
     def delete_face(self, name):
         self._load_names()
@@ -281,7 +357,169 @@ class FaceDatabaseManager:
 
         shutil.rmtree(os.path.join(self.database_root, name))
         logger.debug(f'Delete folder {os.path.join(self.database_root, name)}')
-        self.name_embeddings_dict.pop(name)
+        self._remove_member_embeddings(name)
+        self.name_embeddings_dict.pop(name, None)
+        self._remove_from_matrix(name)
+    
+    def _reset_embedding_matrix(self):
+        # all embeddings in one contiguous matrix, with the label of each row in a parallel array
+        self.embedding_matrix = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        self.embedding_labels = np.zeros((0,), dtype=np.int32)
+        self.embedding_count = 0
+        self.label_names = []
+        self.name_labels = {}
+        if self.ann_index is not None:
+            self.ann_index.clear()
+    
+    def _append_to_matrix(self, name, embeddings):
+        embeddings = np.reshape(embeddings, (-1, EMBEDDING_DIM)).astype(np.float32)
+        if name not in self.name_labels:
+            self.name_labels[name] = len(self.label_names)
+            self.label_names.append(name)
+        count = self.embedding_count
+        new_count = count + len(embeddings)
+        if new_count > len(self.embedding_matrix): # grow capacity by doubling
+            capacity = max(new_count, 2 * len(self.embedding_matrix), MIN_MATRIX_CAPACITY)
+            matrix = np.zeros((capacity, EMBEDDING_DIM), dtype=np.float32)
+            matrix[:count] = self.embedding_matrix[:count]
+            labels = np.zeros((capacity,), dtype=np.int32)
+            labels[:count] = self.embedding_labels[:count]
+            self.embedding_matrix = matrix
+            self.embedding_labels = labels
+        self.embedding_matrix[count:new_count] = embeddings
+        self.embedding_labels[count:new_count] = self.name_labels[name]
+        self.embedding_count = new_count
+        if self.ann_index is not None:
+            self.ann_index.add(embeddings, self.name_labels[name])
+    
+    def _remove_from_matrix(self, name):
+        if name not in self.name_labels:
+            return
+        label = self.name_labels.pop(name)
+        self.label_names[label] = None
+        count = self.embedding_count
+        keep = self.embedding_labels[:count] != label
+        # new arrays, the matrix may be the read-only memory map of embedding_store
+        self.embedding_matrix = self.embedding_matrix[:count][keep]
+        self.embedding_labels = self.embedding_labels[:count][keep]
+        self.embedding_count = len(self.embedding_matrix)
+        if self.ann_index is not None:
+            self.ann_index.remove_label(label)
+    
+    def _load_matrix_from_store(self):
+        # the memory map of the store is used as the matrix directly, a copy is made only when it changes
+        matrix, row_names, _ = self.embedding_store.get_rows()
+        names = set(self.names)
+        keep = np.array([name in names for name in row_names], dtype=bool)
+        if not keep.all(): # members deleted outside
+            matrix = matrix[keep]
+            row_names = [name for name, kept in zip(row_names, keep) if kept]
+        self.label_names = list(dict.fromkeys(row_names))
+        self.name_labels = {name: label for label, name in enumerate(self.label_names)}
+        self.embedding_matrix = matrix
+        self.embedding_labels = np.array([self.name_labels[name] for name in row_names], dtype=np.int32)
+        self.embedding_count = len(matrix)
+        # embeddings of each member are slices of the matrix sorted by label, the rows are gathered only if a member's rows are not together
+        if np.all(np.diff(self.embedding_labels) >= 0):
+            grouped = matrix
+        else:
+            grouped = matrix[np.argsort(self.embedding_labels, kind='stable')]
+        ends = np.cumsum(np.bincount(self.embedding_labels, minlength=len(self.label_names)))
+        for label, name in enumerate(self.label_names):
+            start = ends[label-1] if label > 0 else 0
+            self.name_embeddings_dict[name] = grouped[start:ends[label]]
+    
+    def _migrate_to_store(self):
+        # move embeddings.npy of each member into a new store, once
+        migrated = 0
+        for name in self.names:
+            embaddings_path = os.path.join(self.database_root, name, 'embeddings.npy')
+            if not os.path.exists(embaddings_path):
+                continue
+            try:
+                embaddings = np.load(embaddings_path, allow_pickle=True)
+            except Exception as e:
+                logger.warning(f'Failed to load embeddings for {name}, error: {e}')
+                continue
+            self.embedding_store.append(name, embaddings)
+            migrated += 1
+        if migrated > 0:
+            logger.info(f'Migrate embeddings of {migrated} members into embedding store')
+    
+    def _save_member_embeddings(self, name, embeddings, image_ids = None):
+        if self.embedding_store is None:
+            np.save(os.path.join(self.database_root, name, 'embeddings.npy'), embeddings)
+            return
+        if image_ids is None or len(image_ids) != len(embeddings):
+            image_ids = [''] * len(embeddings)
+        stored, stored_ids = self.embedding_store.get_member(name)
+        if stored is not None and stored_ids == list(image_ids) and np.array_equal(stored, embeddings):
+            return # unchanged, nothing appended to the store
+        self.embedding_store.replace(name, embeddings, image_ids)
+    
+    def _remove_member_embeddings(self, name):
+        # embeddings.npy is removed with the folder of the member
+        if self.embedding_store is not None:
+            self.embedding_store.remove(name)
+        self.pending_embeddings = [pending for pending in self.pending_embeddings if pending[0] != name]
+    
+    def _build_ann_index(self):
+        # centroids are kept next to the database, the lists are filled from the embedding matrix
+        if self.ann_index is None:
+            return
+        path = os.path.join(self.database_root, ANN_INDEX_FILE)
+        matrix, labels, _ = self.get_embedding_matrix()
+        if not self.ann_index.load(path):
+            self.ann_index.clear()
+        self.ann_index.add(matrix, labels)
+        if self.ann_index.needs_training(len(matrix)):
+            self.ann_index.train(matrix)
+            self.ann_index.save(path)
+    
+    def _load_manifest(self):
+        '''
+        output: dict of image content hash to its embedding, None if the image has no valid face.
+        Empty if the manifest is generated with other recognizer settings (det_size, models...)
+        '''
+        path = os.path.join(self.database_root, EMBEDDING_MANIFEST_FILE)
+        if not os.path.exists(path):
+            return {}
+        try:
+            data = np.load(path)
+            config = str(data['config']) if 'config' in data.files else None
+            hashes = data['hashes'].tolist()
+            embeddings = data['embeddings']
+            valid = data['valid']
+        except Exception as e:
+            logger.warning(f'Failed to load embedding manifest, error: {e}')
+            return {}
+        if config != self._embedding_config():
+            logger.info('Recognizer settings changed, embedding manifest is not used')
+            return {}
+        return {content_hash: (embeddings[i] if valid[i] else None) for i, content_hash in enumerate(hashes)}
+    
+    def _save_manifest(self, manifest):
+        path = os.path.join(self.database_root, EMBEDDING_MANIFEST_FILE)
+        hashes = list(manifest.keys())
+        embeddings = np.zeros((len(hashes), EMBEDDING_DIM), dtype=np.float32)
+        valid = np.zeros((len(hashes),), dtype=bool)
+        for i, content_hash in enumerate(hashes):
+            if manifest[content_hash] is not None:
+                embeddings[i] = manifest[content_hash]
+                valid[i] = True
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                np.savez(f, config=np.array(self._embedding_config()), hashes=np.array(hashes, dtype=str), embeddings=embeddings, valid=valid)
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            logger.warning(f'Failed to save embedding manifest, error: {e}')
+            return
+        logger.debug(f'Save embedding manifest with {len(hashes)} images')
+    
+    def _embedding_config(self):
+        if self.face_recognizer is None:
+            return ''
+        return self.face_recognizer.embedding_config()
     
     def _load_names(self):
         # load all names in database into self.names
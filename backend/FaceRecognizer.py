@@ -1,28 +1,156 @@
+import hashlib
 import logging
 import numpy as np
 import os
 import random
 import cv2
 import glob
+import onnxruntime
 
 from insightface.app import FaceAnalysis
+from insightface.app.common import Face
+from insightface.model_zoo import ArcFaceONNX, Attribute, Landmark, RetinaFace
+from insightface.model_zoo.model_zoo import ModelRouter, PickableInferenceSession
+from insightface.utils import ensure_available
 
 logger = logging.getLogger()
 
 MAX_EMBEDDING_NUM = 15
 GOOD_FACE_QUALITY = 0.8
 LEAST_IMG_SIZE = 80
+MIN_EYE_DISTANCE_RATIO = 0.25 # eye distance / bbox width, smaller means a side face
+GRAPH_OPTIMIZATION_LEVELS = {
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'off': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+}
+
+def intra_op_thread_count(intra_op_threads = 0):
+    '''
+    output: threads used inside one operator, 0 (auto) is half of the cpu cores
+    '''
+    if intra_op_threads == 0:
+        return max(1, (os.cpu_count() or 2) // 2)
+    return intra_op_threads
+
+def make_session_options(intra_op_threads = 0, inter_op_threads = 1, graph_optimization = 'all', memory_arena = True):
+    '''
+    input:
+    intra_op_threads: threads used inside one operator, 0 for half of the cpu cores,
+                      so the models do not oversubscribe the cores with decoding and transcribing running together
+    inter_op_threads: threads used to run operators in parallel
+    graph_optimization: all, extended, basic or off
+    memory_arena: whether to use the cpu memory arena of onnxruntime
+    
+    output:
+    onnxruntime.SessionOptions
+    '''
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.intra_op_num_threads = intra_op_thread_count(intra_op_threads)
+    sess_options.inter_op_num_threads = inter_op_threads
+    sess_options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL if inter_op_threads > 1 else onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    sess_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[graph_optimization]
+    sess_options.enable_cpu_mem_arena = memory_arena
+    return sess_options
+
+def file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def route_model(model_file, session):
+    '''
+    The same routing as insightface ModelRouter.get_model, with a session already created.
+    The model is built with the original model file, ArcFaceONNX and Landmark read their input mean and std from its graph.
+    '''
+    input_shape = session.get_inputs()[0].shape
+    if len(session.get_outputs()) >= 5:
+        return RetinaFace(model_file=model_file, session=session)
+    elif input_shape[2] == 192 and input_shape[3] == 192:
+        return Landmark(model_file=model_file, session=session)
+    elif input_shape[2] == 96 and input_shape[3] == 96:
+        return Attribute(model_file=model_file, session=session)
+    elif input_shape[2] == input_shape[3] and input_shape[2] >= 112 and input_shape[2] % 16 == 0:
+        return ArcFaceONNX(model_file=model_file, session=session)
+    return None
 
 class FaceRecognizer(FaceAnalysis):
     def __init__(self, 
-                 ctx_id = 0, 
                  det_thresh = 0.5, det_size = (320, 320), 
-                 name = 'face_lmk', 
-                 providers = ['CUDAExecutionProvider'], 
-                 allowed_modules = ['detection', 'recognition', 'landmark_2d_106']):
-        super().__init__(name = name, providers = providers, allowed_modules = allowed_modules)
-        self.prepare(ctx_id, det_thresh, det_size)
-        logger.info("FaceRecognizer initialized")
+                 name = 'face_lmk', root = '~/.insightface', 
+                 device = 'cpu', 
+                 intra_op_threads = 0, inter_op_threads = 1, 
+                 graph_optimization = 'all', memory_arena = True, 
+                 model_cache_dir = None, 
+                 allowed_modules = ['detection', 'recognition', 'landmark_2d_106'],
+                 strict_enrollment = False):
+        '''
+        device: cpu or cuda
+        intra_op_threads, inter_op_threads, graph_optimization, memory_arena: session options, see make_session_options
+        model_cache_dir: folder to keep the optimized models, so later starts skip the graph optimization. None to disable
+        strict_enrollment: detect again on the cropped face before adding it to database,
+        otherwise only the detection result of the frame is checked
+        '''
+        # the same as FaceAnalysis.__init__, with session options passed to every model
+        onnxruntime.set_default_logger_severity(3)
+        if device == 'cuda':
+            providers = ['CUDAExecutionProvider', 'CPUExecutionProvider']
+        else:
+            providers = ['CPUExecutionProvider']
+        session_config = {'intra_op_threads': intra_op_threads, 'inter_op_threads': inter_op_threads, 
+                          'graph_optimization': graph_optimization, 'memory_arena': memory_arena}
+        self.model_cache_dir = model_cache_dir
+        if model_cache_dir is not None:
+            os.makedirs(model_cache_dir, exist_ok=True)
+        self.models = {}
+        self.model_name = name
+        self.model_dir = ensure_available('models', name, root=root)
+        for onnx_file in sorted(glob.glob(os.path.join(self.model_dir, '*.onnx'))):
+            model = self._load_model(onnx_file, providers, session_config)
+            if model is None:
+                logger.warning(f'Model not recognized: {onnx_file}')
+            elif model.taskname not in allowed_modules or model.taskname in self.models:
+                logger.debug(f'Model ignored: {onnx_file} {model.taskname}')
+            else:
+                logger.debug(f'Model loaded: {onnx_file} {model.taskname}')
+                self.models[model.taskname] = model
+        assert 'detection' in self.models
+        self.det_model = self.models['detection']
+        
+        self.strict_enrollment = strict_enrollment
+        # providers are already set on the sessions, a negative ctx_id would only create every session again
+        self.prepare(0, det_thresh, det_size)
+        logger.info(f"FaceRecognizer initialized on {device}")
+
+    def _load_model(self, onnx_file, providers, session_config):
+        '''
+        Load a model, with its optimized graph from model_cache_dir if cached, otherwise the optimized graph is saved there.
+        The cache is keyed by the model file hash, the graph optimization level, the providers and onnxruntime version,
+        other session options (threads, memory arena) do not change the optimized graph.
+        '''
+        if self.model_cache_dir is None:
+            return ModelRouter(onnx_file).get_model(providers=providers, sess_options=make_session_options(**session_config))
+        
+        key = hashlib.sha1(f'{file_hash(onnx_file)}_{session_config["graph_optimization"]}_{providers}_{onnxruntime.__version__}'.encode()).hexdigest()
+        optimized_file = os.path.join(self.model_cache_dir, f'{os.path.splitext(os.path.basename(onnx_file))[0]}_{key[:16]}.onnx')
+        try:
+            if os.path.exists(optimized_file):
+                # already optimized, no need to optimize again when loading
+                session = PickableInferenceSession(optimized_file, providers=providers, sess_options=make_session_options(**dict(session_config, graph_optimization='off')))
+                logger.debug(f'Load optimized model {optimized_file}')
+            else:
+                sess_options = make_session_options(**session_config)
+                sess_options.optimized_model_filepath = optimized_file + '.tmp'
+                session = PickableInferenceSession(onnx_file, providers=providers, sess_options=sess_options)
+                os.replace(optimized_file + '.tmp', optimized_file)
+                logger.debug(f'Save optimized model {optimized_file}')
+        except Exception as e:
+            logger.warning(f'Failed to use optimized model cache for {onnx_file}, error: {e}')
+            return ModelRouter(onnx_file).get_model(providers=providers, sess_options=make_session_options(**session_config))
+        return route_model(onnx_file, session)
 
     def generate_embedding(self, img):
         if img.shape[0] < LEAST_IMG_SIZE or img.shape[1] < LEAST_IMG_SIZE:
@@ -40,36 +168,82 @@ class FaceRecognizer(FaceAnalysis):
         logger.debug(f'Generated embedding shape: {embeddings.shape}')
         return embeddings
 
-    def generate_embeddings_from_folder(self, image_folder):
+    def generate_embeddings_from_folder(self, image_folder, known_embeddings = None, image_ids = None):
+        '''
+        known_embeddings: dict of image content hash to its embedding (None if the image has no valid face),
+                          images already in it are not processed again, every image in the folder is set to it
+        image_ids: list to get the file name of the image of each returned embedding
+        '''
         embeddings = []
+        files_used = []
         files = glob.glob(f'{image_folder}\*.png')
         logger.debug(f'Found {len(files)} images in {os.path.basename(image_folder)}\'s dataset.')
         
+        reused = 0
         for file in files:
-            img = cv2.imread(file)
-            if img.shape[0] < LEAST_IMG_SIZE or img.shape[1] < LEAST_IMG_SIZE:
-                logger.warning(f'In {os.path.basename(image_folder)}\'s dataset: {file} picture is too small.')
-                continue
-            
-            faces = self.get(img)
-            if len(faces) != 1:
-                logger.warning(f'In {os.path.basename(image_folder)}\'s dataset: {file} has {len(faces)} faces.')
-                continue
-            if faces[0].det_score < GOOD_FACE_QUALITY:
-                logger.warning(f'In {os.path.basename(image_folder)}\'s dataset: {file} has bad quality face.')
-                continue
-            
-            embeddings.append(faces[0].normed_embedding)
+            with open(file, 'rb') as f:
+                data = f.read()
+            content_hash = hashlib.sha1(data).hexdigest()
+            if known_embeddings is not None and content_hash in known_embeddings:
+                embedding = known_embeddings[content_hash]
+                reused += 1
+            else:
+                embedding = self._embedding_from_image(image_folder, file, cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR))
+            if known_embeddings is not None:
+                known_embeddings[content_hash] = embedding
+            if embedding is not None:
+                embeddings.append(embedding)
+                files_used.append(os.path.basename(file))
+        if reused > 0:
+            logger.debug(f'Reused embeddings of {reused} unchanged images in {os.path.basename(image_folder)}\'s dataset.')
             
         if len(embeddings) == 0:
             logger.warning(f'No any valid face detected in {os.path.basename(image_folder)}\'s dataset, return None.')
             return None
         if len(embeddings) > MAX_EMBEDDING_NUM:
-            embeddings = random.choices(embeddings, k = MAX_EMBEDDING_NUM)
+            # same choice for the same folder, so unchanged embeddings are not stored again
+            chosen = sorted(random.Random(len(embeddings)).sample(range(len(embeddings)), MAX_EMBEDDING_NUM))
+            embeddings = [embeddings[i] for i in chosen]
+            files_used = [files_used[i] for i in chosen]
+        if image_ids is not None:
+            image_ids.extend(files_used)
         embeddings = np.stack(embeddings, axis=0) # turn into Ndarray
         logger.debug(f'Generated embeddings shape: {embeddings.shape}')
         return embeddings
 
+    def _embedding_from_image(self, image_folder, file, img):
+        '''
+        output: normed embedding of the only face in a database image, None if not valid
+        '''
+        if img is None:
+            logger.warning(f'In {os.path.basename(image_folder)}\'s dataset: {file} can not be read.')
+            return None
+        if img.shape[0] < LEAST_IMG_SIZE or img.shape[1] < LEAST_IMG_SIZE:
+            logger.warning(f'In {os.path.basename(image_folder)}\'s dataset: {file} picture is too small.')
+            return None
+        
+        faces = self.get(img)
+        if len(faces) != 1:
+            logger.warning(f'In {os.path.basename(image_folder)}\'s dataset: {file} has {len(faces)} faces.')
+            return None
+        if faces[0].det_score < GOOD_FACE_QUALITY:
+            logger.warning(f'In {os.path.basename(image_folder)}\'s dataset: {file} has bad quality face.')
+            return None
+        return faces[0].normed_embedding
+
+    def embedding_config(self):
+        '''
+        output: str of the settings database embeddings depend on, embeddings generated with other settings are not reused
+        '''
+        model_files = sorted([f'{os.path.basename(model.model_file)}:{os.path.getsize(model.model_file)}' for model in self.models.values()])
+        return f'{self.model_name}_{self.det_size}_{self.det_thresh}_{self.strict_enrollment}_{model_files}'
+
+    def memory_size(self):
+        '''
+        output: estimated bytes of the loaded models, by the size of their files
+        '''
+        return sum([os.path.getsize(model.model_file) for model in self.models.values()])
+
     def get_faces(self, image):
         faces = self.get(image)
         logger.debug(f'Found {len(faces)} faces')
@@ -88,45 +262,69 @@ class FaceRecognizer(FaceAnalysis):
         None if face is not known and creating_new_face is set to false
         and a bool to show if the face is new added
         '''
-        face_emb_dict = fdm.get_name_embeddings_dict()
-        if face.det_score < GOOD_FACE_QUALITY: # make sure the quality of face is good
-            logger.debug('Bad quality face.')
-            return None, False
+        return self.get_names(image, [face], fdm, create_new_face, new_face_threshold, search_threshold)[0]
+
+    def get_names(self, image, faces, fdm, create_new_face=False, new_face_threshold = 0.3, search_threshold=0.4):
+        '''
+        get_name for all faces of a frame at once, the similarity search is done once for all faces
+        input:
+        image: mat_like image
+        faces: list of Face in the image
+        fdm: FaceDatabaseManager
+        
+        output:
+        list of (name, is_new) for each face, same as get_name
+        '''
+        results = [(None, False)] * len(faces)
+        if len(faces) == 0:
+            return results
         
+        # make sure the quality of face is good
+        det_scores = np.array([face.det_score for face in faces])
+        good = np.flatnonzero(det_scores >= GOOD_FACE_QUALITY)
+        if len(good) < len(faces):
+            logger.debug(f'{len(faces) - len(good)} bad quality faces.')
+        if len(good) == 0:
+            return results
+        
+        embs = np.stack([faces[i].normed_embedding for i in good], axis=0)
+        name_scores = self._search_similar_batch(embs, fdm)
+        scores = np.array([name_score[1] if name_score is not None else -np.inf for name_score in name_scores])
+        
+        known = scores > new_face_threshold # atleast not a new face
+        # faces not similar enough are added to database, as a new member if under new_face_threshold
         if create_new_face:
-            face_image = self._crop_face_image(image, face)
-            if face_image.shape[0] < LEAST_IMG_SIZE or face_image.shape[1] < LEAST_IMG_SIZE: # make sure the quality of picture to add to database
-                create_new_face = False
-            face_from_face_image = self.get(face_image)
-            if len(face_from_face_image) == 1:
-                if face_from_face_image[0].det_score < GOOD_FACE_QUALITY:
-                    create_new_face = False
-            else:
-                create_new_face = False
-            
-        pred_name_score = self._search_similar(face.normed_embedding, face_emb_dict)
-        if pred_name_score is None:
-            if create_new_face:
-                logger.info('No face in database, creating new face...')
-                new_name = fdm.add_new_face(face_image, embedding = face.normed_embedding)
-                return new_name, True
-            else:
-                return None, False
+            to_add = scores < search_threshold
+        else:
+            to_add = np.zeros(len(good), dtype=bool)
         
-        if pred_name_score[1] < search_threshold and create_new_face:
-            if pred_name_score[1] < new_face_threshold: # create new face in database
+        for j in np.flatnonzero(known | to_add):
+            i = good[j]
+            face_image = self._crop_face_to_add(image, faces[i]) if to_add[j] else None
+            if face_image is None:
+                results[i] = (name_scores[j][0], False) if known[j] else (None, False)
+            elif scores[j] < new_face_threshold: # create new face in database
                 logger.info('Unrecognized face, creating new face in database')
-                new_name = fdm.add_new_face(face_image, embedding = face.normed_embedding)
-                return new_name, True
+                new_name = fdm.add_new_face(face_image, embedding = faces[i].normed_embedding)
+                results[i] = (new_name, True)
             else:
                 logger.info('Add new face data to this member')
-                fdm.add_new_face(face_image, name = pred_name_score[0], embedding = face.normed_embedding) # add new face data to this member
-                return pred_name_score[0], False
-            
-        if pred_name_score[1] > new_face_threshold: # atleast not a new face
-            return pred_name_score[0], False
+                fdm.add_new_face(face_image, name = name_scores[j][0], embedding = faces[i].normed_embedding) # add new face data to this member
+                results[i] = (name_scores[j][0], False)
+        return results
+
+    def get_landmarks(self, image, bboxes):
+        '''
+        run only the landmark model on known face boxes, without detection and recognition
+        input:
+        image: mat_like image
+        bboxes: list of [x1, y1, x2, y2] in pixels
         
-        return None, False
+        output:
+        list of (106, 2) landmarks
+        '''
+        model = self.models['landmark_2d_106']
+        return [model.get(image, Face(bbox=np.asarray(bbox, dtype=np.float32))) for bbox in bboxes]
 
     def get_landmark(self, face):
         if len(face.landmark_2d_106) == 106:
@@ -159,6 +357,76 @@ class FaceRecognizer(FaceAnalysis):
         
         return name_scores[0]
 
+    def _search_similar_batch(self, embs_to_search, fdm):
+        '''
+        search all embeddings at once against the embedding matrix of database
+        input:
+        embs_to_search: (N, 512) normed embeddings
+        fdm: FaceDatabaseManager
+        
+        output:
+        list of [name, score] with highest similarity score for each embedding
+        None if not found
+        '''
+        matrix, labels, label_names = fdm.get_embedding_matrix()
+        if len(matrix) == 0:
+            logger.warning('No face in database.')
+            return [None] * len(embs_to_search)
+        
+        ann_index = fdm.get_ann_index()
+        if ann_index is not None and ann_index.is_trained():
+            best_labels, best_scores = ann_index.search(embs_to_search)
+        else:
+            scores = np.dot(np.asarray(embs_to_search, dtype=np.float32), matrix.T) # (N, M), one GEMM for all faces
+            # the best row is also the best of each member's max score
+            best_rows = np.argmax(scores, axis=1)
+            best_labels = labels[best_rows]
+            best_scores = scores[np.arange(len(scores)), best_rows]
+        best_scores = np.round(best_scores, 3)
+        name_scores = [(label_names[label], float(score)) if label >= 0 else None for label, score in zip(best_labels, best_scores)]
+        logger.debug(f'best name and scores: {name_scores}')
+        return name_scores
+
+    def _crop_face_to_add(self, image, face):
+        '''
+        output: cropped face image if it is good enough to add to database, otherwise None
+        '''
+        if not self._is_enrollable(image, face):
+            return None
+        face_image = self._crop_face_image(image, face)
+        if face_image.shape[0] < LEAST_IMG_SIZE or face_image.shape[1] < LEAST_IMG_SIZE: # make sure the quality of picture to add to database
+            return None
+        if self.strict_enrollment:
+            face_from_face_image = self.get(face_image)
+            if len(face_from_face_image) != 1 or face_from_face_image[0].det_score < GOOD_FACE_QUALITY:
+                return None
+        return face_image
+
+    def _is_enrollable(self, image, face):
+        '''
+        check the face with what the frame detection already gives: det_score, bbox and keypoints
+        output: bool
+        '''
+        if face.det_score < GOOD_FACE_QUALITY:
+            return False
+        x1, y1, x2, y2 = face.bbox
+        # face cut by the border of image
+        if x1 < 0 or y1 < 0 or x2 > image.shape[1] or y2 > image.shape[0]:
+            return False
+        if face.kps is None:
+            return True
+        # all keypoints (eyes, nose, mouth corners) inside the bbox
+        kps = face.kps
+        if np.any(kps[:, 0] < x1) or np.any(kps[:, 0] > x2) or np.any(kps[:, 1] < y1) or np.any(kps[:, 1] > y2):
+            return False
+        # frontal enough: eyes not too close and nose between them
+        left_eye, right_eye, nose = kps[0], kps[1], kps[2]
+        if right_eye[0] - left_eye[0] < (x2 - x1) * MIN_EYE_DISTANCE_RATIO:
+            return False
+        if not left_eye[0] < nose[0] < right_eye[0]:
+            return False
+        return True
+
     def _crop_face_image(self, image, face):
         box = face.bbox.astype(int)
         img_hei = image.shape[0]
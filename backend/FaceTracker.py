@@ -0,0 +1,222 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger()
+
+IOU_THRESHOLD = 0.3 # least IoU between a predicted track and a detection to be matched
+STABLE_IOU = 0.5 # a match under this IoU is not trusted, the identity is checked again
+MAX_MISSES = 5 # frames a track is kept without being detected
+REFRESH_INTERVAL = 900 # frames before the identity of a track is checked again, scene cuts and drift are checked separately
+VELOCITY_SMOOTHING = 0.5
+EMBEDDING_SMOOTHING = 0.9 # weight of the running mean embedding when a new embedding comes
+QUALITY_MARGIN = 0.05 # recognize again when det_score beats the quality used for the name by this margin
+DRIFT_SIMILARITY = 0.5 # recognize again when the running mean embedding is less similar than this to the recognized one
+
+def iou_matrix(boxes_a, boxes_b):
+    '''
+    input: (N, 4) and (M, 4) boxes in [x1, y1, x2, y2]
+    output: (N, M) IoU of each pair
+    '''
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    y1 = np.maximum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    x2 = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    y2 = np.minimum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return inter / np.maximum(union, 1e-6)
+
+def move_points(points, from_bbox, to_bbox):
+    '''
+    Move points (like landmarks) inside from_bbox to the same relative position in to_bbox
+    '''
+    from_bbox = np.asarray(from_bbox, dtype=np.float32)
+    to_bbox = np.asarray(to_bbox, dtype=np.float32)
+    scale = (to_bbox[2:] - to_bbox[:2]) / np.maximum(from_bbox[2:] - from_bbox[:2], 1e-6)
+    return (np.asarray(points, dtype=np.float32) - from_bbox[:2]) * scale + to_bbox[:2]
+
+class Track:
+    def __init__(self, track_id, bbox, frame_idx):
+        self.id = track_id
+        self.bbox = np.asarray(bbox, dtype=np.float32)
+        self.velocity = np.zeros((4,), dtype=np.float32) # bbox change per frame
+        self.frame_idx = frame_idx # frame of last detection
+        self.misses = 0
+        self.match_iou = 0.0 # IoU of last match, 0 for a new track
+        self.name = None
+        self.recognized_idx = None # frame of last recognition
+        # embedding cache
+        self.embedding = None # latest embedding
+        self.quality = 0.0 # det_score of latest embedding
+        self.best_embedding = None # embedding the name is recognized with
+        self.best_quality = 0.0
+        self.mean_embedding = None # running mean since last recognition
+        self.similarity = 1.0 # similarity of the running mean to best_embedding
+        self.landmark = None # latest landmark
+        self.landmark_bbox = None # bbox the latest landmark is found in
+
+    def predict(self, frame_idx):
+        return self.bbox + self.velocity * (frame_idx - self.frame_idx)
+
+    def update(self, bbox, frame_idx, match_iou):
+        bbox = np.asarray(bbox, dtype=np.float32)
+        frames = max(frame_idx - self.frame_idx, 1)
+        velocity = (bbox - self.bbox) / frames
+        self.velocity = VELOCITY_SMOOTHING * self.velocity + (1 - VELOCITY_SMOOTHING) * velocity
+        self.bbox = bbox
+        self.frame_idx = frame_idx
+        self.misses = 0
+        self.match_iou = match_iou
+
+    def observe(self, embedding, quality):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self.embedding = embedding
+        self.quality = quality
+        if self.mean_embedding is None:
+            self.mean_embedding = embedding
+            return
+        mean = EMBEDDING_SMOOTHING * self.mean_embedding + (1 - EMBEDDING_SMOOTHING) * embedding
+        self.mean_embedding = mean / np.linalg.norm(mean)
+        if self.best_embedding is not None:
+            self.similarity = float(np.dot(self.mean_embedding, self.best_embedding))
+
+class FaceTracker:
+    '''
+    Track faces between frames by IoU matching against constant-velocity predictions.
+    Every face gets a persistent track ID, and the identity of each track is cached, so
+    recognition is only needed for new tracks, unstable matches and periodic refreshes.
+    Each track also caches the embedding its name is recognized with and a running mean of its embeddings,
+    the name is recognized again only when a clearly better quality face comes or the embeddings drift away.
+    '''
+    def __init__(self, iou_threshold = IOU_THRESHOLD, max_misses = MAX_MISSES, refresh_interval = REFRESH_INTERVAL):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.refresh_interval = refresh_interval
+        self.tracks = {}
+        self.next_id = 0
+
+    def reset(self):
+        logger.debug('FaceTracker reset')
+        self.tracks = {}
+
+    def update(self, bboxes, frame_idx):
+        '''
+        Match detections of a frame to the tracks, unmatched detections start new tracks.
+        input:
+        bboxes: list of [x1, y1, x2, y2] detected in this frame
+        frame_idx: index of this frame
+
+        output:
+        list of track id of each bbox
+        '''
+        bboxes = np.asarray(bboxes, dtype=np.float32).reshape(-1, 4)
+        track_list = list(self.tracks.values())
+        track_ids = [None] * len(bboxes)
+
+        if len(track_list) > 0 and len(bboxes) > 0:
+            predicted = np.stack([track.predict(frame_idx) for track in track_list], axis=0)
+            ious = iou_matrix(predicted, bboxes)
+            # greedy matching, best pairs first
+            for flat in np.argsort(-ious, axis=None):
+                t, d = np.unravel_index(flat, ious.shape)
+                if ious[t, d] < self.iou_threshold:
+                    break
+                if track_ids[d] is not None or track_list[t].frame_idx == frame_idx:
+                    continue
+                track_list[t].update(bboxes[d], frame_idx, float(ious[t, d]))
+                track_ids[d] = track_list[t].id
+
+        for d in range(len(bboxes)):
+            if track_ids[d] is None:
+                track = Track(self.next_id, bboxes[d], frame_idx)
+                self.tracks[track.id] = track
+                self.next_id += 1
+                track_ids[d] = track.id
+                logger.debug(f'New track {track.id}')
+
+        for track in track_list:
+            if track.frame_idx != frame_idx:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    del self.tracks[track.id]
+                    logger.debug(f'Drop track {track.id}')
+        return track_ids
+
+    def observe(self, track_id, embedding, quality):
+        '''
+        Feed the embedding of the face detected for a track in this frame.
+        input:
+        embedding: normed embedding of the face
+        quality: det_score of the face
+        '''
+        self.tracks[track_id].observe(embedding, quality)
+
+    def set_landmark(self, track_id, landmark, bbox = None):
+        '''
+        Set the latest landmark of the track, found in bbox (the bbox of last detection if None).
+        '''
+        track = self.tracks[track_id]
+        track.landmark = landmark
+        track.landmark_bbox = track.bbox if bbox is None else np.asarray(bbox, dtype=np.float32)
+
+    def predict(self, frame_idx):
+        '''
+        Predict the tracks detected in the last detection for a frame without detection.
+        output: list of (track_id, bbox, landmark), landmark is moved with the bbox, None if not set
+        '''
+        predictions = []
+        for track in self.tracks.values():
+            if track.misses > 0:
+                continue
+            bbox = track.predict(frame_idx)
+            landmark = None
+            if track.landmark is not None:
+                landmark = move_points(track.landmark, track.landmark_bbox, bbox)
+            predictions.append((track.id, bbox, landmark))
+        return predictions
+
+    def hold(self, frame_idx):
+        '''
+        Keep the tracks detected in the last detection where they are, for a frame known to have no motion.
+        output: list of (track_id, bbox)
+        '''
+        held = []
+        for track in self.tracks.values():
+            if track.misses > 0:
+                continue
+            track.update(track.bbox, frame_idx, 1.0)
+            held.append((track.id, track.bbox))
+        return held
+
+    def needs_recognition(self, track_id):
+        track = self.tracks[track_id]
+        if track.name is None or track.match_iou < STABLE_IOU:
+            return True
+        if track.quality > track.best_quality + QUALITY_MARGIN:
+            logger.debug(f'Track {track_id} has better quality face: {track.quality} > {track.best_quality}')
+            return True
+        if track.similarity < DRIFT_SIMILARITY:
+            logger.debug(f'Track {track_id} drifted, similarity: {track.similarity}')
+            return True
+        return track.frame_idx - track.recognized_idx >= self.refresh_interval
+
+    def set_name(self, track_id, name):
+        '''
+        Set the name recognized with the latest observed embedding of the track.
+        '''
+        track = self.tracks[track_id]
+        if track.name is not None and name != track.name:
+            logger.debug(f'Track {track_id} changed from {track.name} to {name}')
+        track.name = name
+        track.recognized_idx = track.frame_idx
+        if track.embedding is not None:
+            track.best_embedding = track.embedding
+            track.best_quality = track.quality
+            track.mean_embedding = track.embedding
+            track.similarity = 1.0
+
+    def get_name(self, track_id):
+        return self.tracks[track_id].name
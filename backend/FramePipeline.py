@@ -0,0 +1,128 @@
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger()
+
+QUEUE_SIZE = 8
+POLL_INTERVAL = 0.1
+
+_END = object() # marks the end of the stream in a queue
+
+class FramePipeline:
+    '''
+    Run frame processing as a chain of stages, each in its own thread, linked by bounded queues.
+    The source produces packets (return None when finished), every stage receives a packet and
+    returns it (modified) to the next stage. A packet stays in order through the whole chain.
+    '''
+    def __init__(self, source, stages, queue_size = QUEUE_SIZE):
+        '''
+        input:
+        source: callable, returns the next packet or None at the end of stream. raise to abort.
+        stages: list of (name, callable), callable gets a packet and returns the packet for next stage
+        queue_size: max packets waiting between two stages
+        '''
+        self.source = source
+        self.stages = stages
+        self.queue_size = queue_size
+        self.running = False
+        self.stopped = False # stop() before run() is kept, so the pipeline does not start
+        self._state_lock = threading.Lock()
+        self.completed = False
+        self.error = None
+        self.stage_time = {}
+        logger.debug(f'FramePipeline created with stages: {[name for name, _ in stages]}')
+
+    def run(self):
+        '''
+        Start all stages and block until the stream ends, stop() is called or any stage raised.
+        output: bool - whether the source reached its end and every packet went through all stages
+        '''
+        with self._state_lock:
+            if self.stopped:
+                logger.info('Pipeline stopped before it started')
+                return False
+            self.running = True
+        self.completed = False
+        self.error = None
+        self.stage_time = {'decode': 0.0}
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages))]
+        threads = [threading.Thread(target=self._source_loop, args=(queues[0],), name='decode')]
+        for i, (name, func) in enumerate(self.stages):
+            self.stage_time[name] = 0.0
+            out_queue = queues[i+1] if i+1 < len(queues) else None
+            threads.append(threading.Thread(target=self._stage_loop, args=(name, func, queues[i], out_queue), name=name))
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.running = False
+        logger.debug(f'Stage busy time: { {name: round(t, 2) for name, t in self.stage_time.items()} }')
+        return self.completed and self.error is None
+
+    def stop(self):
+        with self._state_lock:
+            if self.running:
+                logger.info('Stop pipeline')
+            self.stopped = True
+            self.running = False
+
+    def _source_loop(self, out_queue):
+        try:
+            while self.running:
+                start_time = time.monotonic()
+                packet = self.source()
+                self.stage_time['decode'] += time.monotonic() - start_time
+                if packet is None:
+                    break
+                if not self._put(out_queue, packet):
+                    break
+        except Exception as e:
+            self._fail('decode', e)
+        self._put(out_queue, _END)
+
+    def _stage_loop(self, name, func, in_queue, out_queue):
+        while True:
+            packet = self._get(in_queue)
+            if packet is _END:
+                if out_queue is None and self.running and self.error is None:
+                    self.completed = True
+                break
+            try:
+                start_time = time.monotonic()
+                packet = func(packet)
+                self.stage_time[name] += time.monotonic() - start_time
+            except Exception as e:
+                self._fail(name, e)
+                break
+            if out_queue is not None and not self._put(out_queue, packet):
+                break
+        if out_queue is not None:
+            self._put(out_queue, _END)
+
+    def _put(self, q, item):
+        while self.running:
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q):
+        while self.running:
+            try:
+                return q.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _fail(self, name, error):
+        logger.error(f'Stage "{name}" failed: {error}')
+        if self.error is None:
+            self.error = error
+        self.running = False
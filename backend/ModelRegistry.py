@@ -0,0 +1,129 @@
+import ctypes
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+MAX_MODEL_MB = 8192 # budget when the available memory is unknown
+AVAILABLE_MEMORY_RATIO = 0.75 # budget in ratio of the memory available at start, with max_mb 0
+
+def available_memory():
+    '''
+    output: bytes of physical memory available now, None if unknown
+    '''
+    try:
+        if os.name == 'nt':
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong),
+                            ('ullTotalPhys', ctypes.c_ulonglong), ('ullAvailPhys', ctypes.c_ulonglong),
+                            ('ullTotalPageFile', ctypes.c_ulonglong), ('ullAvailPageFile', ctypes.c_ulonglong),
+                            ('ullTotalVirtual', ctypes.c_ulonglong), ('ullAvailVirtual', ctypes.c_ulonglong),
+                            ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                return None
+            return status.ullAvailPhys
+        if os.path.exists('/proc/meminfo'):
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) * 1024
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError) as e:
+        logger.warning(f"Failed to get available memory: {e}")
+        return None
+
+class ModelRegistry:
+    '''
+    Keep loaded models keyed by their configuration, so runs with the same settings reuse them.
+    The least recently used models are released when the estimated memory goes over the budget,
+    except the models in use (set by set_in_use()) and busy ones.
+    A model may have memory_size() (in bytes) to be counted, is_busy() to be kept while working,
+    and close() to be called when released.
+    '''
+    def __init__(self, max_mb = 0):
+        '''
+        max_mb: memory budget of the models, 0 to derive it from the memory available now
+        '''
+        if max_mb <= 0:
+            available = available_memory()
+            max_mb = int(available * AVAILABLE_MEMORY_RATIO / 1024 / 1024) if available is not None else MAX_MODEL_MB
+        self.max_bytes = max_mb * 1024 * 1024
+        self.entries = OrderedDict() # key: (model, size), most recently used last
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.in_use = []
+        logger.info(f"ModelRegistry initialized, budget: {max_mb}MB")
+
+    def get(self, key, create):
+        '''
+        input:
+        key: hashable configuration of the model
+        create: callable to load the model if not in registry
+
+        output: the model
+        '''
+        # loading is serialized per key, different models can load at the same time
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    logger.debug(f"Reuse model: {key}")
+                    return self.entries[key][0]
+
+            logger.info(f"Load model: {key}")
+            model = create()
+            size = model.memory_size() if hasattr(model, 'memory_size') else 0
+            with self.lock:
+                self.entries[key] = (model, size)
+                released = self._evict(keep=key)
+            for released_key, released_model in released:
+                logger.info(f"Release model: {released_key}")
+                if hasattr(released_model, 'close'):
+                    released_model.close()
+            return model
+
+    def set_in_use(self, models):
+        '''
+        models: list of models used by the running process, they are never released
+        '''
+        with self.lock:
+            self.in_use = list(models)
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def clear(self):
+        with self.lock:
+            released = [(key, model) for key, (model, _) in self.entries.items()]
+            self.entries.clear()
+        for _, model in released:
+            if hasattr(model, 'close'):
+                model.close()
+
+    def total_size(self):
+        return sum([size for _, size in self.entries.values()])
+
+    def _evict(self, keep):
+        # called with self.lock held, output: list of (key, model) removed
+        released = []
+        if self.entries[keep][1] > self.max_bytes:
+            # releasing the others would not make it fit
+            logger.warning(f"Model {keep} alone is over the budget: {self.entries[keep][1] // 1024 // 1024}MB > {self.max_bytes // 1024 // 1024}MB")
+            return released
+        for key in list(self.entries.keys()):
+            if self.total_size() <= self.max_bytes:
+                break
+            model = self.entries[key][0]
+            if key == keep or any([model is used for used in self.in_use]):
+                continue
+            if hasattr(model, 'is_busy') and model.is_busy():
+                continue
+            released.append((key, self.entries.pop(key)[0]))
+        return released
@@ -0,0 +1,55 @@
+import logging
+import cv2
+import numpy as np
+
+logger = logging.getLogger()
+
+MOTION_WIDTH = 64 # width of the downscaled frame to compare
+PIXEL_DIFF = 15 # gray level difference counted as a changed pixel
+FACE_MARGIN = 0.5 # region around a face box to check, in ratio of the box size
+
+class MotionDetector:
+    '''
+    Cheap motion check by differencing a tiny grayscale copy of the frame against the last frame with motion.
+    '''
+    def __init__(self, threshold, width = MOTION_WIDTH):
+        '''
+        threshold: ratio of changed pixels, in the whole frame or around any face box, to count as motion
+        '''
+        self.threshold = threshold
+        self.width = width
+        self.reference = None
+
+    def reset(self):
+        self.reference = None
+
+    def update(self, frame, bboxes):
+        '''
+        Compare the frame with the reference, the frame becomes the new reference if it has motion.
+        input:
+        frame: BGR image
+        bboxes: list of [x1, y1, x2, y2] of known faces, in pixels
+
+        output: bool - whether anything changed
+        '''
+        scale = self.width / frame.shape[1]
+        height = max(int(frame.shape[0] * scale), 1)
+        small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (self.width, height), interpolation=cv2.INTER_AREA).astype(np.int16)
+        if self.reference is None or self.reference.shape != small.shape:
+            self.reference = small
+            return True
+
+        changed = np.abs(small - self.reference) > PIXEL_DIFF
+        moved = changed.mean() > self.threshold
+        for bbox in bboxes:
+            if moved:
+                break
+            x1, y1, x2, y2 = np.asarray(bbox, dtype=np.float32) * scale
+            margin_x = (x2 - x1) * FACE_MARGIN
+            margin_y = (y2 - y1) * FACE_MARGIN
+            region = changed[max(int(y1 - margin_y), 0):int(np.ceil(y2 + margin_y)), max(int(x1 - margin_x), 0):int(np.ceil(x2 + margin_x))]
+            moved = region.size > 0 and region.mean() > self.threshold
+
+        if moved:
+            self.reference = small
+        return moved
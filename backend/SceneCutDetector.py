@@ -0,0 +1,52 @@
+import logging
+import cv2
+import numpy as np
+
+logger = logging.getLogger()
+
+HIST_WIDTH = 128 # width of the downscaled frame for histogram
+HUE_BINS = 16
+SATURATION_BINS = 4
+VALUE_BINS = 4
+CUT_THRESHOLD = 0.5 # histogram difference (1 - intersection) of two frames to be a cut
+
+class SceneCutDetector:
+    '''
+    Detect hard cuts (camera switch) by comparing the color histogram of each frame with the previous one.
+    '''
+    def __init__(self, threshold = CUT_THRESHOLD, width = HIST_WIDTH):
+        self.threshold = threshold
+        self.width = width
+        self.last_hist = None
+
+    def reset(self):
+        self.last_hist = None
+
+    def histogram(self, frame):
+        '''
+        output: normalized HSV histogram of the frame, flatten to 1D
+        '''
+        height = max(int(frame.shape[0] * self.width / frame.shape[1]), 1)
+        small = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV).reshape(-1, 3).astype(np.int32)
+        # opencv hue is in [0, 180)
+        bins = (hsv[:, 0] * HUE_BINS // 180) * SATURATION_BINS * VALUE_BINS \
+             + (hsv[:, 1] * SATURATION_BINS // 256) * VALUE_BINS \
+             + (hsv[:, 2] * VALUE_BINS // 256)
+        hist = np.bincount(bins, minlength=HUE_BINS * SATURATION_BINS * VALUE_BINS).astype(np.float32)
+        return hist / len(bins)
+
+    def update(self, frame):
+        '''
+        output: bool - whether the frame starts a new scene, the first frame does not
+        '''
+        hist = self.histogram(frame)
+        last_hist = self.last_hist
+        self.last_hist = hist
+        if last_hist is None:
+            return False
+        difference = 1.0 - float(np.minimum(hist, last_hist).sum())
+        if difference > self.threshold:
+            logger.debug(f'Scene cut detected, histogram difference: {difference}')
+            return True
+        return False
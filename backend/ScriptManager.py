@@ -1,34 +1,533 @@
+import bisect
 import logging
+import multiprocessing
+import numpy as np
 import os
+import threading
 import time
+import torch
 import whisper
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 logger = logging.getLogger()
 
+SAMPLE_RATE = whisper.audio.SAMPLE_RATE
+CHUNK_SECONDS = 60 # length of each chunk in chunked transcription
+SILENCE_SEARCH_SECONDS = 5 # how far a cut can move to find the quietest point
+ENERGY_FRAME_SECONDS = 0.02
+OVERLAP_SECONDS = 5 # overlap between neighbouring chunks in parallel transcription
+VAD_FRAME_SECONDS = 0.03
+VAD_THRESHOLD_DB = 12 # speech is louder than the noise floor by this, or less when the recording has a small range
+VAD_THRESHOLD_RATIO = 0.5 # the threshold is at most this ratio of the way from the noise floor to the speech level
+VAD_MIN_DB = -55 # frames quieter than this are never speech
+VAD_MIN_SILENCE_SECONDS = 1.0 # shorter pauses stay inside a speech region
+VAD_MIN_SPEECH_SECONDS = 0.3
+VAD_PAD_SECONDS = 0.3
+VAD_MIN_COVERAGE = 0.1 # less speech than this ratio of the audio is not plausible, the whole audio is transcribed then
+WHISPER_PARAMS = {'tiny': 39e6, 'base': 74e6, 'small': 244e6, 'medium': 769e6, 'large': 1550e6} # parameters of each model size
+
+# whisper model loaded in the transcription worker process
+_worker_model = None
+
+def _init_worker(model_name, num_threads = None):
+    global _worker_model
+    if num_threads is not None:
+        torch.set_num_threads(num_threads) # share cores between workers instead of oversubscribing
+    _worker_model = whisper.load_model(model_name)
+
+def _worker_ready():
+    return _worker_model is not None
+
+def _transcribe_in_worker(audio, language, initial_prompt = None):
+    _result = whisper.transcribe(_worker_model, audio, language=language, initial_prompt=initial_prompt, verbose=None)
+    return _simplify_segments(_result['segments'])
+
+def _simplify_segments(segments):
+    # post process of result (only keeps segments and only the start, end, text)
+    result = []
+    for s in segments:
+        new_s = {'start':round(s['start'], 3), 'end':round(s['end'], 3), 'text':s['text']}
+        result.append(new_s)
+    return result
+
+def _chunk_audio(audio, pieces):
+    if len(pieces) == 1:
+        return audio[pieces[0][0]:pieces[0][1]]
+    return np.concatenate([audio[start:end] for start, end in pieces])
+
+def _map_segments(segments, pieces):
+    '''
+    Map time of segments transcribed from a chunk back to the whole audio.
+    
+    input:
+    segments: segments of the chunk, time starts from 0
+    pieces: list of (start, end) sample index the chunk is joined from
+    '''
+    lengths = np.array([end - start for start, end in pieces])
+    chunk_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]) / SAMPLE_RATE
+    audio_starts = np.array([start for start, _ in pieces]) / SAMPLE_RATE
+    
+    def to_audio_time(t, side):
+        i = max(int(np.searchsorted(chunk_starts, t, side)) - 1, 0)
+        return round(float(audio_starts[i] + t - chunk_starts[i]), 3)
+    
+    result = []
+    for s in segments:
+        # a segment ending exactly on a joint belongs to the piece before it
+        result.append({'start':to_audio_time(s['start'], 'right'), 'end':to_audio_time(s['end'], 'left'), 'text':s['text']})
+    return result
+
+def _frame_energy(audio, frame_len):
+    n_frames = len(audio) // frame_len
+    frames = audio[:n_frames * frame_len].reshape(n_frames, frame_len)
+    return np.mean(frames * frames, axis=1)
+
+def _split_on_silence(audio, chunk_seconds = CHUNK_SECONDS, search_seconds = SILENCE_SEARCH_SECONDS):
+    '''
+    input:
+    audio: 1-D float array sampled at SAMPLE_RATE
+    chunk_seconds: target length of a chunk
+    search_seconds: a cut is moved to the quietest frame within this range around the target
+    
+    output:
+    list of (start, end) sample index of each chunk, covering the whole audio
+    '''
+    if len(audio) == 0:
+        return []
+    frame_len = int(ENERGY_FRAME_SECONDS * SAMPLE_RATE)
+    chunk_frames = int(chunk_seconds / ENERGY_FRAME_SECONDS)
+    search_frames = int(search_seconds / ENERGY_FRAME_SECONDS)
+    energy = _frame_energy(audio, frame_len)
+    
+    cuts = [0]
+    target = chunk_frames
+    while target + search_frames < len(energy):
+        lo = max(target - search_frames, cuts[-1] + 1)
+        hi = target + search_frames
+        cuts.append(lo + int(np.argmin(energy[lo:hi])))
+        target = cuts[-1] + chunk_frames
+    
+    bounds = [cut * frame_len for cut in cuts] + [len(audio)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _detect_speech(audio):
+    '''
+    Energy based voice activity detection.
+    output: list of (start, end) sample index of speech regions
+    '''
+    frame_len = int(VAD_FRAME_SECONDS * SAMPLE_RATE)
+    energy = _frame_energy(audio, frame_len)
+    if len(energy) == 0:
+        return []
+    db = 10 * np.log10(energy + 1e-10)
+    noise_floor = np.percentile(db, 10)
+    speech_level = np.percentile(db, 90)
+    # adapt to the range of the recording, so continuous speech or speech little over the noise is still found
+    threshold = noise_floor + min(VAD_THRESHOLD_DB, (speech_level - noise_floor) * VAD_THRESHOLD_RATIO)
+    speech = db > max(threshold, VAD_MIN_DB)
+    
+    edges = np.diff(np.concatenate([[0], speech.astype(np.int8), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if len(starts) == 0:
+        return []
+    # close short pauses
+    gap_kept = (starts[1:] - ends[:-1]) >= VAD_MIN_SILENCE_SECONDS / VAD_FRAME_SECONDS
+    starts = np.concatenate([starts[:1], starts[1:][gap_kept]])
+    ends = np.concatenate([ends[:-1][gap_kept], ends[-1:]])
+    # drop short noises
+    long_enough = (ends - starts) >= VAD_MIN_SPEECH_SECONDS / VAD_FRAME_SECONDS
+    starts = starts[long_enough]
+    ends = ends[long_enough]
+    
+    pad = int(VAD_PAD_SECONDS * SAMPLE_RATE)
+    starts = np.maximum(starts * frame_len - pad, 0)
+    ends = np.minimum(ends * frame_len + pad, len(audio))
+    return list(zip(starts.tolist(), ends.tolist()))
+
+def _pack_regions(audio, regions, chunk_seconds = CHUNK_SECONDS):
+    '''
+    Group speech regions into chunks holding at most chunk_seconds of audio, a region longer than that is cut on silence.
+    output: list of chunks, a chunk is a list of (start, end) sample index
+    '''
+    chunk_len = chunk_seconds * SAMPLE_RATE
+    pieces = []
+    for start, end in regions:
+        if end - start > chunk_len:
+            pieces.extend([(start + s, start + e) for s, e in _split_on_silence(audio[start:end], chunk_seconds)])
+        else:
+            pieces.append((start, end))
+    
+    chunks = []
+    length = 0
+    for start, end in pieces:
+        if len(chunks) == 0 or length + end - start > chunk_len:
+            chunks.append([])
+            length = 0
+        chunks[-1].append((start, end))
+        length += end - start
+    return chunks
+
+def _split_overlapping(n_samples, chunk_seconds = CHUNK_SECONDS, overlap_seconds = OVERLAP_SECONDS):
+    '''
+    output: list of (start, end) sample index, neighbouring chunks share overlap_seconds of audio
+    '''
+    chunk_len = int(chunk_seconds * SAMPLE_RATE)
+    step = chunk_len - int(overlap_seconds * SAMPLE_RATE)
+    chunks = []
+    start = 0
+    while start < n_samples:
+        end = min(start + chunk_len, n_samples)
+        chunks.append((start, end))
+        if end == n_samples:
+            break
+        start += step
+    return chunks
+
+def _stitch_segments(chunks, chunk_segments):
+    '''
+    Merge segments of overlapping chunks in order. In an overlap, a segment belongs to the chunk
+    on the side of the overlap's middle point where its own middle point is, so it is kept once.
+    
+    input:
+    chunks: list of chunks in order, a chunk is a list of (start, end) sample index
+    chunk_segments: list of segments of each chunk, time is of the whole audio
+    
+    output: list of segments
+    '''
+    result = []
+    for i, segments in enumerate(chunk_segments):
+        lower = (chunks[i][0][0] + chunks[i-1][-1][1]) / 2 / SAMPLE_RATE if i > 0 else float('-inf')
+        upper = (chunks[i+1][0][0] + chunks[i][-1][1]) / 2 / SAMPLE_RATE if i+1 < len(chunks) else float('inf')
+        for s in segments:
+            mid = (s['start'] + s['end']) / 2
+            if mid < lower or mid >= upper:
+                continue
+            if len(result) > 0 and result[-1]['text'] == s['text'] and s['start'] < result[-1]['end']:
+                continue # same line recognized by both chunks
+            result.append(s)
+    return result
+
 class ScriptManager:
-    def __init__(self, model_name = 'small', language = 'zh'):
-        self.model = whisper.load_model(model_name)
+    def __init__(self, model_name = 'small', language = 'zh', workers = 1, vad = False, cache = None, reserved_threads = 0):
+        '''
+        reserved_threads: cpu threads left for the work running beside transcription (face detection), the workers share the rest
+        '''
+        self.model_name = model_name
+        self.model = None # loaded when transcribing in this process
         self.lang = language
-        self.result = None
+        self.workers = max(1, workers)
+        self.vad = vad # only transcribe the speech regions
+        self.cache = cache # TranscriptCache, None for no caching
+        self.reserved_threads = reserved_threads
+        self.result = None # index for time lookups is rebuilt whenever result is set
         self.lock = False
+        self.progress = (0, 0)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._preloading = False
+        self._thread = None
+        self._cancel = threading.Event()
         logger.info("ScriptManager initialized")
     
     def transcribe(self, audio_path:str):
+        if self._load_from_cache(audio_path, 'whole'):
+            return
         logger.info("Start transcription")
         start_time = time.time()
         self.lock = True
+        if self.model is None:
+            self.model = whisper.load_model(self.model_name)
         _result = whisper.transcribe(self.model, audio_path, language=self.lang, verbose=False)
         logger.debug(f"transcribed in {(time.time() - start_time):.2f}s")
-        # post process of result (only keeps segments and only the start, end, text)
-        _result = _result['segments']
-        
-        self.result = []
-        for s in _result:
-            new_s = {'start':round(s['start'], 3), 'end':round(s['end'], 3), 'text':s['text']}
-            self.result.append(new_s)
+        self.result = _simplify_segments(_result['segments'])
+        self._store_to_cache(audio_path, 'whole')
 
         self.lock = False
     
+    def transcribe_chunked(self, audio_path:str, progress_callback = None, in_worker = False):
+        '''
+        Transcribe the audio chunk by chunk, chunks are cut on silence (or joined from speech regions with vad).
+        Checks for cancel_transcription() between chunks (in worker, the running chunk is stopped too), the result is None if cancelled.
+        
+        input:
+        audio_path: the file to transcribe
+        progress_callback: called with (progress, total) in percent after each chunk
+        in_worker: run the model in the worker process instead of this process
+        
+        yield: list of segments of each finished chunk, time is of the whole audio
+        '''
+        logger.info("Start chunked transcription")
+        start_time = time.time()
+        self.lock = True
+        self.result = None
+        segments = []
+        try:
+            audio = whisper.load_audio(audio_path)
+            chunks = self._plan_chunks(audio)
+            if in_worker:
+                self._create_executor()
+            self.progress = (0, 100)
+            for pieces in chunks:
+                if self._cancel.is_set():
+                    logger.info("Transcription cancelled")
+                    return
+                # keep the context of last chunk
+                prompt = segments[-1]['text'] if len(segments) > 0 else None
+                if in_worker:
+                    chunk_segments = self._executor.submit(_transcribe_in_worker, _chunk_audio(audio, pieces), self.lang, prompt).result()
+                else:
+                    if self.model is None:
+                        self.model = whisper.load_model(self.model_name)
+                    chunk_segments = whisper.transcribe(self.model, _chunk_audio(audio, pieces), language=self.lang, initial_prompt=prompt, verbose=None)['segments']
+                chunk_segments = _map_segments(chunk_segments, pieces)
+                segments.extend(chunk_segments)
+                
+                self.progress = (int(pieces[-1][1] / len(audio) * 100), 100)
+                if progress_callback is not None:
+                    progress_callback(*self.progress)
+                yield chunk_segments
+            
+            logger.debug(f"transcribed in {(time.time() - start_time):.2f}s")
+            self.result = segments
+        except Exception:
+            if not self._cancel.is_set():
+                raise
+            logger.info("Transcription cancelled") # the worker is terminated while transcribing
+        finally:
+            self._cancel.clear()
+            self.lock = False
+    
+    def transcribe_parallel(self, audio_path:str, progress_callback = None):
+        '''
+        Transcribe overlapping chunks of the audio at the same time in the worker processes,
+        each worker holds its own model. cancel_transcription() terminates the workers, the result is None if cancelled.
+        
+        input:
+        audio_path: the file to transcribe
+        progress_callback: called with (progress, total) in finished chunks after each chunk
+        '''
+        logger.info(f"Start parallel transcription with {self.workers} workers")
+        start_time = time.time()
+        self.lock = True
+        self.result = None
+        try:
+            self._create_executor()
+            audio = whisper.load_audio(audio_path)
+            chunks = self._plan_chunks(audio, overlap=True)
+            self.progress = (0, len(chunks))
+            futures = {self._executor.submit(_transcribe_in_worker, _chunk_audio(audio, pieces), self.lang): i for i, pieces in enumerate(chunks)}
+            
+            chunk_segments = [None] * len(chunks)
+            done = 0
+            for future in as_completed(futures):
+                if self._cancel.is_set():
+                    logger.info("Transcription cancelled")
+                    for f in futures:
+                        f.cancel()
+                    return
+                i = futures[future]
+                chunk_segments[i] = _map_segments(future.result(), chunks[i])
+                done += 1
+                self.progress = (done, len(chunks))
+                if progress_callback is not None:
+                    progress_callback(*self.progress)
+            
+            self.result = _stitch_segments(chunks, chunk_segments)
+            logger.debug(f"transcribed in {(time.time() - start_time):.2f}s")
+        except Exception:
+            if not self._cancel.is_set():
+                raise
+            logger.info("Transcription cancelled") # the workers are terminated while transcribing
+        finally:
+            self._cancel.clear()
+            self.lock = False
+    
+    def start_transcription(self, audio_path:str):
+        '''
+        Start transcription in worker processes and return immediately, chunk by chunk
+        with one worker, or chunks in parallel with more workers.
+        Call wait_transcription() to collect the result.
+        '''
+        if self._thread is not None:
+            self._thread.join() # a cancelled one stops once its workers are terminated
+        mode = 'parallel' if self.workers > 1 else 'chunked'
+        if self._load_from_cache(audio_path, mode):
+            return
+        logger.info("Start transcription in worker process")
+        self.lock = True
+        self.result = None
+        self.progress = (0, 0)
+        self._create_executor()
+        
+        def transcription_loop():
+            try:
+                if self.workers > 1:
+                    self.transcribe_parallel(audio_path)
+                else:
+                    for _ in self.transcribe_chunked(audio_path, in_worker=True):
+                        pass
+                self._store_to_cache(audio_path, mode)
+            except Exception as e:
+                logger.error(f"Transcription failed: {e}")
+                self.result = None
+        
+        self._thread = threading.Thread(target=transcription_loop)
+        self._thread.start()
+    
+    def wait_transcription(self, progress_callback = None):
+        '''
+        Block until the transcription started by start_transcription() is done.
+        progress_callback: called with (progress, total) whenever progress changes
+        output: bool - whether the result is ready
+        '''
+        thread = self._thread
+        if thread is None:
+            return self.result is not None
+        last_progress = None
+        while thread.is_alive():
+            if progress_callback is not None and self.progress != last_progress:
+                last_progress = self.progress
+                progress_callback(*last_progress)
+            thread.join(0.5)
+        # a transcription started in the meantime keeps its thread
+        if self._thread is thread:
+            self._thread = None
+        return self.result is not None
+    
+    def transcription_alive(self):
+        '''
+        output: bool - whether the transcription started by start_transcription() has its result, or is still running and not cancelled
+        '''
+        if self.result is not None:
+            return True
+        return self._thread is not None and self._thread.is_alive() and not self._cancel.is_set()
+    
+    def cancel_transcription(self):
+        '''
+        Stop the running transcription. The worker processes are terminated instead of waiting for the running chunks,
+        which takes minutes on CPU with larger models, the next transcription starts them and loads the model again.
+        '''
+        if not self.lock:
+            return
+        logger.info("Cancel transcription")
+        self._cancel.set()
+        self._terminate_workers()
+    
+    def _terminate_workers(self):
+        with self._executor_lock:
+            executor = self._executor
+            self._executor = None
+        if executor is None:
+            return
+        # ProcessPoolExecutor has no public way to stop a running task
+        processes = list((executor._processes or {}).values())
+        for process in processes:
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+        logger.debug(f"Terminated {len(processes)} transcription worker(s)")
+    
+    @property
+    def result(self):
+        return self._result
+    
+    @result.setter
+    def result(self, result):
+        self._result = result
+        self._build_index()
+    
+    def _build_index(self):
+        # segments sorted by start time, with the running max of end time to handle overlapping segments
+        self._index_segments = sorted(self._result, key=lambda s: s['start']) if self._result is not None else []
+        self._index_starts = [s['start'] for s in self._index_segments]
+        self._index_max_ends = []
+        max_end = float('-inf')
+        for s in self._index_segments:
+            max_end = max(max_end, s['end'])
+            self._index_max_ends.append(max_end)
+    
+    def _load_from_cache(self, audio_path, mode):
+        '''
+        mode: 'whole', 'chunked' or 'parallel', the transcription the cached result must come from
+        output: bool - whether the result is loaded from cache
+        '''
+        if self.cache is None:
+            return False
+        # vad only applies to the chunked modes
+        result = self.cache.get(self.cache.fingerprint(audio_path), self.model_name, self.lang, self.vad and mode != 'whole', mode)
+        if result is None:
+            return False
+        self.result = result
+        self.progress = (100, 100)
+        return True
+    
+    def _store_to_cache(self, audio_path, mode):
+        if self.cache is None or self.result is None:
+            return
+        self.cache.put(self.cache.fingerprint(audio_path), self.model_name, self.lang, self.vad and mode != 'whole', mode, self.result)
+    
+    def _plan_chunks(self, audio, overlap = False):
+        '''
+        output: list of chunks to transcribe, a chunk is a list of (start, end) sample index joined into one input
+        '''
+        chunks = None
+        if self.vad:
+            regions = _detect_speech(audio)
+            speech_len = sum([end - start for start, end in regions])
+            logger.debug(f"VAD found {len(regions)} speech regions, {speech_len / SAMPLE_RATE:.1f}s of {len(audio) / SAMPLE_RATE:.1f}s")
+            if speech_len < len(audio) * VAD_MIN_COVERAGE:
+                logger.warning(f"VAD found only {speech_len / SAMPLE_RATE:.1f}s of speech, transcribe the whole audio instead")
+            else:
+                # chunks are cut between speech regions, no overlap needed
+                chunks = _pack_regions(audio, regions)
+        if chunks is None and overlap:
+            chunks = [[chunk] for chunk in _split_overlapping(len(audio))]
+        elif chunks is None:
+            chunks = [[chunk] for chunk in _split_on_silence(audio)]
+        logger.debug(f"Split audio into {len(chunks)} chunks")
+        return chunks
+    
+    def _create_executor(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                return
+            num_threads = max(1, ((os.cpu_count() or 1) - self.reserved_threads) // self.workers)
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_init_worker, initargs=(self.model_name, num_threads))
+    
+    def preload(self):
+        '''
+        Start the worker processes and load the model in them, so the next transcription starts right away.
+        '''
+        self._preloading = True
+        try:
+            self._create_executor()
+            futures = [self._executor.submit(_worker_ready) for _ in range(self.workers)]
+            for future in futures:
+                future.result()
+        finally:
+            self._preloading = False
+        logger.info(f"Whisper model {self.model_name} loaded in {self.workers} worker(s)")
+    
+    def is_busy(self):
+        '''
+        output: bool - whether it is transcribing or loading the model, it should not be closed then
+        '''
+        return self.lock or self._preloading
+    
+    def memory_size(self):
+        '''
+        output: estimated bytes of the whisper models (float32) in the worker processes and this process
+        '''
+        params = WHISPER_PARAMS.get(self.model_name.split('.')[0].split('-')[0], WHISPER_PARAMS['large'])
+        return int(params * 4 * (self.workers + (1 if self.model is not None else 0)))
+    
+    def close(self):
+        self.cancel_transcription()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+    
     def get_result(self):
         '''
         output:
@@ -60,11 +559,36 @@ class ScriptManager:
             logger.warning('Time must be positive float.')
             return ''
         
-        for s in self.result:
-            if s['start'] <= _time and s['end'] >= _time:
+        i = bisect.bisect_right(self._index_starts, _time) - 1
+        while i >= 0 and self._index_max_ends[i] >= _time:
+            s = self._index_segments[i]
+            if s['end'] >= _time:
                 return s['text'] if s['text'] else ''
+            i -= 1
         return ''
     
+    def get_scripts_in_range(self, _from:float, _to:float):
+        '''
+        input:
+        _from: the start time of time range in second
+        _to: the end time of time range in second
+        
+        output: [list] segments overlapping the time range, ordered by start time
+        '''
+        if self.result == None:
+            logger.warning("No result now")
+            return []
+        if self.lock:
+            logger.warning("Result not ready")
+            return []
+        if _from > _to:
+            logger.warning("Start time large then end time")
+            return []
+        
+        lo = bisect.bisect_left(self._index_max_ends, _from)
+        hi = bisect.bisect_right(self._index_starts, _to)
+        return [s for s in self._index_segments[lo:hi] if s['end'] >= _from]
+    
     def print_script(self):
         '''
         output: formated logger.warning to cmd console, for debug uses
@@ -93,12 +617,13 @@ class ScriptManager:
             logger.warning("Wait until process ended.")
             return 
         logger.debug(f"Loading script file: {path}")
-        self.result = []
+        result = []
         with open(path, 'r') as f:
             lines = f.readlines()
         for line in lines:
             s = line.strip().split('_')
-            self.result.append({'start':float(s[0]), 'end':float(s[1]), 'text':s[2]})
+            result.append({'start':float(s[0]), 'end':float(s[1]), 'text':s[2]})
+        self.result = result
         logger.info(f"Script file loaded: {path}")
 
     def load_script_from_record(self, record):
@@ -128,8 +653,10 @@ class ScriptManager:
             logger.warning("Start time large then end time")
             return False
         
-        for s in self.result:
-            if  s['start'] <= _from <= s['end'] or s['start'] <= _to <= s['end']:
+        lo = bisect.bisect_left(self._index_max_ends, _from)
+        hi = bisect.bisect_right(self._index_starts, _to)
+        for s in self._index_segments[lo:hi]:
+            if s['end'] >= _from:
                 return True
         return False
     
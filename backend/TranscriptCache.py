@@ -0,0 +1,105 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger()
+
+FINGERPRINT_BLOCK_SIZE = 1024 * 1024
+MAX_CACHE_MB = 200
+MAX_CACHE_DAYS = 30
+CACHE_FORMAT_VERSION = 1 # bump when the segments produced for the same key change, older entries are never hit again
+
+def video_fingerprint(path):
+    '''
+    Fast fingerprint of a file, hashes its size and three blocks (head, middle, tail) instead of the whole file.
+    output: [str] hex digest
+    '''
+    size = os.path.getsize(path)
+    sha = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        for offset in (0, max(size // 2 - FINGERPRINT_BLOCK_SIZE // 2, 0), max(size - FINGERPRINT_BLOCK_SIZE, 0)):
+            f.seek(offset)
+            sha.update(f.read(FINGERPRINT_BLOCK_SIZE))
+    return sha.hexdigest()
+
+class TranscriptCache:
+    '''
+    On-disk cache of transcription results, keyed by video fingerprint, whisper model, language, vad, transcription mode and format version.
+    One json file per entry, the least recently used entries are evicted when the cache is too large or too old.
+    '''
+    def __init__(self, cache_dir = 'transcript_cache', max_mb = MAX_CACHE_MB, max_days = MAX_CACHE_DAYS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 1024 * 1024
+        self.max_age = max_days * 24 * 60 * 60
+        os.makedirs(self.cache_dir, exist_ok=True)
+        logger.info(f'TranscriptCache initialized at {cache_dir}')
+
+    def fingerprint(self, video_path):
+        return video_fingerprint(video_path)
+
+    def get(self, fingerprint, model_name, language, vad, mode):
+        '''
+        input:
+        vad: whether only the speech regions are transcribed
+        mode: how the audio is transcribed ('whole', 'chunked' or 'parallel'), segments differ between modes
+        
+        output: list of segments, None if not cached
+        '''
+        path = self._entry_path(fingerprint, model_name, language, vad, mode)
+        if not os.path.exists(path):
+            logger.debug(f'Transcript cache miss: {fingerprint} {model_name} {language} vad={vad} {mode}')
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except Exception as e:
+            logger.warning(f'Failed to read transcript cache entry, drop it: {e}')
+            os.remove(path)
+            return None
+        os.utime(path) # mark as recently used
+        logger.info(f'Transcript cache hit: {fingerprint} {model_name} {language} vad={vad} {mode}')
+        return entry['segments']
+
+    def put(self, fingerprint, model_name, language, vad, mode, segments):
+        if segments is None:
+            return
+        path = self._entry_path(fingerprint, model_name, language, vad, mode)
+        entry = {'version': CACHE_FORMAT_VERSION, 'fingerprint': fingerprint, 'model_name': model_name, 'language': language,
+                 'vad': vad, 'mode': mode, 'create_time': time.time(), 'segments': segments}
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            logger.warning(f'Failed to write transcript cache entry: {e}')
+            return
+        logger.debug(f'Transcript cached: {fingerprint} {model_name} {language} vad={vad} {mode}')
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove entries not used for max_days, then the least recently used ones until the cache fits in max_mb.
+        '''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort() # oldest first
+
+        now = time.time()
+        total_size = sum([size for _, size, _ in entries])
+        for mtime, size, path in entries:
+            if now - mtime < self.max_age and total_size <= self.max_bytes:
+                break
+            os.remove(path)
+            total_size -= size
+            logger.debug(f'Evict transcript cache entry: {os.path.basename(path)}')
+
+    def _entry_path(self, fingerprint, model_name, language, vad, mode):
+        key = hashlib.sha1(f'{CACHE_FORMAT_VERSION}_{fingerprint}_{model_name}_{language}_{bool(vad)}_{mode}'.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json')
@@ -8,11 +8,19 @@ import os
 import shutil
 import threading
 
+from AnnIndex import IVFIndex
+from EmbeddingStore import EmbeddingStore
 from FaceAnalyzer import FaceAnalyzer
 from FaceDatabaseManager import FaceDatabaseManager
-from FaceRecognizer import FaceRecognizer
+from FaceRecognizer import FaceRecognizer, intra_op_thread_count
+from FaceTracker import FaceTracker
+from FramePipeline import FramePipeline
+from ModelRegistry import ModelRegistry
+from MotionDetector import MotionDetector
 from Record import Record
+from SceneCutDetector import SceneCutDetector
 from ScriptManager import ScriptManager
+from TranscriptCache import TranscriptCache
 from VideoManager import VideoManager
 
 from Utils import *
@@ -24,34 +32,46 @@ default_params = config['DEFAULT']
 param_aliases = config['ALIASES']
 
 logger = logging.getLogger()
-logger.handlers.clear()
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter(
-	'[%(levelname)-7s %(asctime)s] %(name)s:%(module)s:%(funcName)s:%(lineno)d: %(message)s',
-	'%H:%M:%S')
 
-fileLogger = logging.FileHandler('log.txt', mode='w')
-fileLogger.setLevel(logging.DEBUG)
-fileLogger.setFormatter(formatter)
+def init_logger():
+    # only in the main process, worker processes (spawn) import this module again and must not truncate log.txt
+    logger.handlers.clear()
+    logger.setLevel(logging.DEBUG)
+    formatter = logging.Formatter(
+        '[%(levelname)-7s %(asctime)s] %(name)s:%(module)s:%(funcName)s:%(lineno)d: %(message)s',
+        '%H:%M:%S')
 
-streamLogger = logging.StreamHandler()
-streamLogger.setLevel(logging.DEBUG)
-streamLogger.setFormatter(formatter)
+    fileLogger = logging.FileHandler('log.txt', mode='w')
+    fileLogger.setLevel(logging.DEBUG)
+    fileLogger.setFormatter(formatter)
 
-logger.addHandler(fileLogger)
-logger.addHandler(streamLogger)
+    streamLogger = logging.StreamHandler()
+    streamLogger.setLevel(logging.DEBUG)
+    streamLogger.setFormatter(formatter)
+
+    logger.addHandler(fileLogger)
+    logger.addHandler(streamLogger)
 
 class Backend():
     def __init__(self):
         super().__init__()
         self.si = SocketInterface()
-        self.si.imServer()
-                
         self.params = {}
+        for key, _ in default_params.items():
+            self.params[key] = default_params[key].split(",")[0]
+        
+        self.transcript_cache = TranscriptCache(config['STORE_DIR']['TRANSCRIPT_CACHE'],
+                                                max_mb=int(config['CACHE']['TRANSCRIPT_CACHE_MB']),
+                                                max_days=int(config['CACHE']['TRANSCRIPT_CACHE_DAYS']))
+        # loaded FaceRecognizer and ScriptManager, reused by runs with the same settings, MODEL_CACHE_MB 0 for a budget by available memory
+        self.models = ModelRegistry(max_mb=int(config['CACHE']['MODEL_CACHE_MB']))
+        # load models of default parameters while waiting for the frontend
+        self.preload_models()
+        self.si.imServer()
         
         # connect signals
-        self.si.connect_signal("selectedVideo", self.set_video_path, True)
-        self.si.connect_signal("selectedDatabase", self.set_database_path, True)
+        self.si.connect_signal("selectedVideo", self.select_video, True)
+        self.si.connect_signal("selectedDatabase", self.select_database, True)
         self.si.connect_signal("deleteDatabase", self.delete_database, True)
         self.si.connect_signal("createDatabase", self.create_database, True)
         self.si.connect_signal("selectedRecord", self.set_record_file, True)
@@ -74,10 +94,15 @@ class Backend():
         self.vm = VideoManager()
         self.record = None
         self.fdm = None
+        self.sm = None
+        self.speculative = None # (video path, ScriptManager) of the transcription started on video selected
+        self.speculative_thread = None
         
         self.running = False
+        self.testing = False # current run is a test run, which does not transcribe
         self.database_name = None
         self.run_thread = None
+        self.pipeline = None
         
         self.cur_process = ""
         self.cur_progress = 0
@@ -90,10 +115,12 @@ class Backend():
                 if type is None:
                     logger.error("Error occurred, exit.")
                     self.terminateProcess()
+                    self.models.clear()
                     self.si.close()
                     break
                 if type == "SIG" and data == "END_PROGRAM":
                     self.terminateProcess()
+                    self.models.clear()
                     self.si.close()
                     break
                     
@@ -127,6 +154,24 @@ class Backend():
         if det_size[0] < 0 or det_size[1] < 0:
             self.raise_error("Both value in det_size must be positive integer.")
             return
+        if not str(self.params['transcribe_workers']).isdigit() or int(self.params['transcribe_workers']) < 1:
+            self.raise_error("transcribe_workers must be positive integer.")
+            return
+        if not str(self.params['detect_stride']).isdigit() or int(self.params['detect_stride']) < 1:
+            self.raise_error("detect_stride must be positive integer.")
+            return
+        if not str(self.params['intra_op_threads']).isdigit():
+            self.raise_error("intra_op_threads must be 0 (auto) or positive integer.")
+            return
+        if not str(self.params['inter_op_threads']).isdigit() or int(self.params['inter_op_threads']) < 1:
+            self.raise_error("inter_op_threads must be positive integer.")
+            return
+        try:
+            if float(self.params['motion_threshold']) < 0:
+                raise ValueError
+        except ValueError:
+            self.raise_error("motion_threshold must be a number not less than 0.")
+            return
         self.cur_progress+=1
         self.update_progress()
         if self.database_name is None:
@@ -147,7 +192,8 @@ class Backend():
             self.cur_progress+=1
             self.update_progress()
             
-            self.fr = FaceRecognizer(det_size=det_size)
+            self.fr = self.get_face_recognizer()
+            self.models.set_in_use([self.fr])
             self.cur_progress+=1
             self.update_progress()
             
@@ -161,10 +207,12 @@ class Backend():
             self.cur_progress+=1
             self.update_progress()
             
-            self.sm = ScriptManager(model_name=self.params['whisper_model'], language=self.params['language'])
+            self.sm = self.get_script_manager()
+            self.models.set_in_use([self.fr, self.sm])
             self.cur_progress+=1
             self.update_progress()
         except Exception as e:
+            self.models.set_in_use([])
             self.raise_error("Error occurred when setting up: " + str(e))
             self.cur_process = "Idle"
             self.cur_progress = 0
@@ -173,6 +221,7 @@ class Backend():
             return
         
         self.running = True
+        self.testing = test
         
         if not test:
             # info
@@ -181,14 +230,17 @@ class Backend():
             for key, _ in default_params.items():
                 self.record.set_parameter(key, self.params[key])
         
-        if not test: # no trinscribing in test mode
-            self.cur_process = "Transcribing..."
-            self.cur_progress = 0
-            self.total_progress = 0
-            self.update_progress()
-            
-            logger.debug("Start transcribing")
-            self.sm.transcribe(self.vm.get_video_path())
+        if not test: # no trinscribing in test mode, transcribe in worker process while processing faces
+            if self.speculative_thread is not None:
+                self.speculative_thread.join()
+            # a speculative transcription cancelled or failed in the meantime is started again
+            if self.speculative == (self.vm.get_video_path(), self.sm) and self.sm.transcription_alive():
+                logger.debug("Use speculative transcription")
+                self.speculative = None
+            else:
+                self.cancel_speculative_transcription()
+                logger.debug("Start transcribing")
+                self.sm.start_transcription(self.vm.get_video_path())
         
         def main_run(test):
             start_time = time.time()
@@ -196,12 +248,20 @@ class Backend():
             self.total_progress = self.vm.get_total_frame()
             self.cur_progress = 0
             self.update_progress()
-            end_safly = False
-            # to deside wether to get name this round, if bboxes are not change too much (position, amount), use last round's name
-            last_round_face_boxes = []
-            last_round_names = []
-            nochange_counter = 0
-            while self.running:                
+            # track faces between frames, names are only recognized for new or unstable tracks
+            tracker = FaceTracker()
+            # detect faces every detect_stride frames, the tracks are followed in between
+            detect_stride = int(self.params['detect_stride'])
+            frames_since_detection = detect_stride
+            landmark_tracking = self.params['landmark_tracking'] == 'on'
+            # skip detection when nothing changed around the faces, motion_threshold 0 to always detect
+            motion_threshold = float(self.params['motion_threshold'])
+            motion_detector = MotionDetector(motion_threshold) if motion_threshold > 0 else None
+            # tracks and names are dropped at a scene cut (camera switch), faces are recognized again right away
+            scene_cut_detector = SceneCutDetector()
+            
+            # decode stage: read frame from video
+            def decode():
                 for i in range(10):
                     frame = self.vm.next_frame()
                     if frame is not None:
@@ -209,116 +269,185 @@ class Backend():
                 if frame is None:
                     if self.vm.is_end():
                         logger.info("End of video")
-                        self.running = False
-                        end_safly = True
-                        break
-                    self.raise_error("Failed to get frame")
+                        return None
                     logger.warning("Failed to get frame")
-                    self.running = False
-                    end_safly = False
-                    break
+                    raise RuntimeError("Failed to get frame")
+                # new_members: (name, image) found in this frame, sent to frontend by the render stage
+                return {'frame': frame, 'frame_idx': self.vm.get_cur_frame_idx(), 'scene_cut': scene_cut_detector.update(frame), 'new_members': []}
+            
+            # detect/recognize stage: find faces and their names
+            def detect(packet):
+                nonlocal frames_since_detection
+                if packet['scene_cut']:
+                    logger.info(f"Scene cut at frame {packet['frame_idx']}")
+                    tracker.reset()
+                    if motion_detector is not None:
+                        motion_detector.reset()
+                    frames_since_detection = detect_stride
+                if frames_since_detection + 1 < detect_stride:
+                    frames_since_detection += 1
+                    return follow_tracks(packet)
+                frames_since_detection = 0
                 
-                faces = self.fr.get_faces(frame)
+                if motion_detector is not None and not motion_detector.update(packet['frame'], [bbox for _, bbox, _ in tracker.predict(packet['frame_idx'])]):
+                    return hold_tracks(packet)
+                return detect_faces(packet, self.fr.get_faces(packet['frame']))
+            
+            def detect_faces(packet, faces):
+                frame = packet['frame']
+                faces = sorted(faces, key=lambda x: x.bbox[0])
+                track_ids = tracker.update([face.bbox for face in faces], packet['frame_idx'])
+                for face, track_id in zip(faces, track_ids):
+                    tracker.observe(track_id, face.normed_embedding, face.det_score)
+                    tracker.set_landmark(track_id, self.fr.get_landmark(face))
+                
+                to_recognize = [i for i in range(len(faces)) if tracker.needs_recognition(track_ids[i])]
+                if len(to_recognize) > 0:
+                    name_results = self.fr.get_names(frame, [faces[i] for i in to_recognize], self.fdm, create_new_face=True)
+                    for i, (name, is_new) in zip(to_recognize, name_results):
+                        tracker.set_name(track_ids[i], name)
+                        if is_new:
+                            packet['new_members'].append((name, self.fdm.get_images_by_name(name)[0]))
+                    logger.debug(f"Recognized tracks: {[track_ids[i] for i in to_recognize]}")
+                
+                landmarks = []
                 bboxes = []
-                for i in range(len(faces)):
-                    bbox = faces[i].bbox.astype(int).tolist()
-                    logger.debug(f"{bbox}")
-                    bbox[0] /= self.vm.width
-                    bbox[1] /= self.vm.height
-                    
-                    bbox[2] /= self.vm.width
-                    bbox[3] /= self.vm.height
-                    bboxes.append(bbox)
+                names = []
+                for face, track_id in zip(faces, track_ids):
+                    name = tracker.get_name(track_id)
+                    if name is None:
+                        continue
+                    landmarks.append(self.fr.get_landmark(face))
+                    bboxes.append(ratio_bbox(face.bbox))
+                    names.append(name)
+                logger.debug(f"Names: {names}")
                 
-                face_boxes = sorted(list(zip(faces, bboxes)), key=lambda x: x[1][0])
-        
-                need_to_get_name = True
-                if len(last_round_face_boxes) == len(face_boxes):
-                    closest = 1
-                    for i in range(len(face_boxes)-1):
-                        dis = face_boxes[i+1][1][0] - face_boxes[i][1][0]
-                        closest = min(closest, dis)
-                    logger.debug(f"closest face dis: {closest}")
-                    if closest > 0.1: # no face too close to each other
-                        for i in range(len(face_boxes)):
-                            # diff = [dx1, dy1, dx2, dy2]
-                            diff = np.array(face_boxes[i][1]) - np.array(last_round_face_boxes[i][1])
-                            dis1 = np.sqrt(diff[0]**2 + diff[1]**2)
-                            dis2 = np.sqrt(diff[2]**2 + diff[3]**2)
-                            dis = (dis1 + dis2) / 2
-                            logger.debug(f"bbox diff: {dis}")
-                            if dis > 0.1:
-                                break
-                    need_to_get_name = False
+                packet['landmarks'] = landmarks
+                packet['bboxes'] = bboxes
+                packet['names'] = names
+                return packet
+            
+            # frames between detections: faces follow the predicted bboxes of their tracks,
+            # with landmark_tracking on only the landmark model runs on the predicted bboxes
+            def follow_tracks(packet):
+                predictions = [x for x in tracker.predict(packet['frame_idx']) if tracker.get_name(x[0]) is not None]
+                predictions.sort(key=lambda x: x[1][0])
+                if landmark_tracking:
+                    new_landmarks = self.fr.get_landmarks(packet['frame'], [bbox for _, bbox, _ in predictions])
+                    predictions = [(track_id, bbox, landmark) for (track_id, bbox, _), landmark in zip(predictions, new_landmarks)]
+                    for track_id, bbox, landmark in predictions:
+                        if landmark is not None:
+                            tracker.set_landmark(track_id, landmark, bbox)
                 
+                landmarks = []
+                bboxes = []
                 names = []
-                valid_faces_bboxes = []
-                if need_to_get_name or nochange_counter >= 150:
-                    nochange_counter = 0
-                    for i in range(len(face_boxes)):
-                        name, is_new = self.fr.get_name(frame, face_boxes[i][0], self.fdm, create_new_face=True)
-                        if name is None:
-                            continue
-                        if is_new:
-                            self.si.send_signal("newMemberImage")
-                            self.si.send_data(name)
-                            self.si.send_image(self.fdm.get_images_by_name(name)[0])
-                            
-                        names.append(name)
-                        valid_faces_bboxes.append(face_boxes[i])
-                    logger.debug(f"Names: {names}")
-                    last_round_face_boxes = valid_faces_bboxes
-                    last_round_names = names
-                else:
-                    nochange_counter+=1
-                    valid_faces_bboxes = face_boxes
-                    last_round_face_boxes = face_boxes                        
-                    names = last_round_names
-                    logger.debug(f"use last Names: {names}")
-                        
-                valid_faces = [x[0] for x in valid_faces_bboxes]
-                valid_bboxes = [x[1] for x in valid_faces_bboxes]
+                for track_id, bbox, landmark in predictions:
+                    if landmark is None:
+                        continue
+                    landmarks.append(landmark)
+                    bboxes.append(ratio_bbox(bbox))
+                    names.append(tracker.get_name(track_id))
                 
-                self.fa.update(zip(names, [self.fr.get_landmark(x) for x in valid_faces]))
+                packet['landmarks'] = landmarks
+                packet['bboxes'] = bboxes
+                packet['names'] = names
+                return packet
+            
+            # no motion: faces stay where they are, only their landmarks are updated
+            def hold_tracks(packet):
+                held = [(track_id, bbox) for track_id, bbox in tracker.hold(packet['frame_idx']) if tracker.get_name(track_id) is not None]
+                held.sort(key=lambda x: x[1][0])
+                landmarks = self.fr.get_landmarks(packet['frame'], [bbox for _, bbox in held])
+                bboxes = []
+                names = []
+                for (track_id, bbox), landmark in zip(held, landmarks):
+                    tracker.set_landmark(track_id, landmark)
+                    bboxes.append(ratio_bbox(bbox))
+                    names.append(tracker.get_name(track_id))
+                
+                packet['landmarks'] = landmarks
+                packet['bboxes'] = bboxes
+                packet['names'] = names
+                return packet
+            
+            # bbox in pixels to bbox in ratio of frame size
+            def ratio_bbox(bbox):
+                bbox = bbox.astype(int).tolist()
+                logger.debug(f"{bbox}")
+                bbox[0] /= self.vm.width
+                bbox[1] /= self.vm.height
+                
+                bbox[2] /= self.vm.width
+                bbox[3] /= self.vm.height
+                return bbox
+            
+            # analyze/record stage: talking status of each face, write into record
+            def analyze(packet):
+                names = packet['names']
+                self.fa.update(zip(names, packet['landmarks']))
                 
                 statuses = []
-                for i in range(len(valid_faces)):
+                for i in range(len(names)):
                     status = self.fa.is_talking(names[i])
                     statuses.append(status)
-                    
-                frame_idx = self.vm.get_cur_frame_idx()
+                packet['statuses'] = statuses
                 
                 if not test:
-                    self.record.write_data(frame_idx, valid_bboxes, names, statuses)
-                    
-                #draw on frame
+                    self.record.write_data(packet['frame_idx'], packet['bboxes'], names, statuses)
+                return packet
+            
+            # render/preview stage: draw on frame and send to frontend
+            def render(packet):
+                frame = packet['frame']
+                names = packet['names']
+                valid_bboxes = packet['bboxes']
+                statuses = packet['statuses']
                 if not test:
-                    for i in range(len(valid_faces)):
+                    for i in range(len(valid_bboxes)):
                         x1, y1, x2, y2 = valid_bboxes[i]
                         cv2.rectangle(frame, (int(x1*self.vm.width), int(y1*self.vm.height)), (int(x2*self.vm.width), int(y2*self.vm.height)), (0, 255, 0) if statuses[i] else (225, 0, 0), 5)
                         frame = PutText(frame, names[i], (int(x1*self.vm.width), int(y1*self.vm.height)-20), fontScale=50)
                         #frame = PutText(frame, self.sm.get_script_by_time(time_s), (0, 0), fontScale=50)
                 else:
-                    for i in range(len(valid_faces)):
+                    for i in range(len(valid_bboxes)):
                         x1, y1, x2, y2 = valid_bboxes[i]
                         frame = PutText(frame, "Not Found" if not names[i] else names[i], (int(x1*self.vm.width), int(y1*self.vm.height)-20), fontScale=50)
                         cv2.rectangle(frame, (int(x1*self.vm.width), int(y1*self.vm.height)), (int(x2*self.vm.width), int(y2*self.vm.height)), (0, 255, 0) if statuses[i] else (225, 0, 0), 5)
                 
+                # sent from this stage only, so the messages do not interleave with the preview frames
+                for name, image in packet['new_members']:
+                    self.si.send_signal("newMemberImage")
+                    self.si.send_data(name)
+                    self.si.send_image(image)
+                
                 self.si.send_signal("updateRuntimeImg")
                 self.si.send_image(cv2.resize(frame, (640, 360))) # 640*360
                 
                 self.cur_progress+=1
                 self.update_progress()
+                return packet
+            
+            self.pipeline = FramePipeline(decode, [("detect", detect), ("analyze", analyze), ("render", render)])
+            if not self.running: # terminated before the pipeline was created
+                self.pipeline.stop()
+            end_safly = self.pipeline.run()
+            if self.pipeline.error is not None:
+                self.raise_error(str(self.pipeline.error))
                 
             self.cur_process = "Done"
             self.cur_progress = 0
             self.total_progress = 0
             self.update_progress()
             
-            self.running = False
+            if not test and not end_safly:
+                self.sm.cancel_transcription()
             if not test and end_safly:
                 self.save_record()
                 self.set_record_file(self.record.get_info()['record_name'])
+            # a new run may start only after the transcription of this one is saved
+            self.running = False
+            self.models.set_in_use([])
             self.si.send_signal("processFinished")
             logger.info(f"Process finished/terminated in {time.time() - start_time} seconds")
             
@@ -402,7 +531,93 @@ class Backend():
         self.si.send_signal("updateScript")
         self.si.send_data(script)
 
+    def get_face_recognizer(self):
+        '''
+        output: FaceRecognizer of current parameters, loaded or reused from model registry
+        '''
+        det_size = tuple(map(int, self.params['det_size'].split("x")))
+        fr_config = (det_size, self.params['device'], int(self.params['intra_op_threads']), int(self.params['inter_op_threads']), 
+                     self.params['graph_optimization'], self.params['memory_arena'] == 'on')
+        return self.models.get(('FaceRecognizer',) + fr_config, lambda: FaceRecognizer(det_size=fr_config[0], 
+                                                                                        device=fr_config[1], 
+                                                                                        intra_op_threads=fr_config[2], 
+                                                                                        inter_op_threads=fr_config[3], 
+                                                                                        graph_optimization=fr_config[4], 
+                                                                                        memory_arena=fr_config[5], 
+                                                                                        model_cache_dir=config['STORE_DIR']['MODEL_CACHE']))
+
+    def get_script_manager(self):
+        '''
+        output: ScriptManager of current parameters, loaded or reused from model registry
+        '''
+        # cores used by the face models are left out of the whisper workers
+        sm_config = (self.params['whisper_model'], self.params['language'], int(self.params['transcribe_workers']), self.params['vad'] == 'on', 
+                     intra_op_thread_count(int(self.params['intra_op_threads'])))
+        return self.models.get(('ScriptManager',) + sm_config, lambda: ScriptManager(model_name=sm_config[0], language=sm_config[1], workers=sm_config[2], vad=sm_config[3], 
+                                                                                     cache=self.transcript_cache, reserved_threads=sm_config[4]))
+
+    def preload_models(self):
+        '''
+        Load the models of current parameters in background, run() reuses them from model registry.
+        '''
+        def preload():
+            try:
+                start_time = time.time()
+                self.get_face_recognizer()
+                self.get_script_manager().preload()
+                logger.info(f"Models preloaded in {time.time() - start_time:.2f} seconds")
+            except Exception as e:
+                logger.warning(f"Failed to preload models: {e}")
+        
+        threading.Thread(target=preload, daemon=True).start()
+
+    def start_speculative_transcription(self, video_path):
+        '''
+        Start transcribing the selected video (cache lookup, audio loading and transcription) in background before run.
+        run() reuses it if the video and the transcription parameters are not changed, otherwise it is cancelled.
+        '''
+        self.cancel_speculative_transcription()
+        
+        def speculate():
+            try:
+                sm = self.get_script_manager()
+                sm.start_transcription(video_path)
+                self.speculative = (video_path, sm)
+                logger.info(f"Speculative transcription started: {os.path.basename(video_path)}")
+            except Exception as e:
+                logger.warning(f"Failed to start speculative transcription: {e}")
+        
+        self.speculative_thread = threading.Thread(target=speculate, daemon=True)
+        self.speculative_thread.start()
+
+    def cancel_speculative_transcription(self):
+        if self.speculative_thread is not None:
+            self.speculative_thread.join()
+            self.speculative_thread = None
+        if self.speculative is not None:
+            logger.info("Cancel speculative transcription")
+            self.speculative[1].cancel_transcription()
+            self.speculative = None
+
+    def select_video(self, video_path):
+        '''
+        A video selected in frontend, models of current parameters are loaded and the video is transcribed in background.
+        Not done by set_video_path(), set_record_file() calls it before the parameters of the record are set.
+        '''
+        if not self.set_video_path(video_path):
+            return
+        self.preload_models()
+        if self.params['speculative'] == 'on' and not self.running:
+            self.start_speculative_transcription(video_path)
+
+    def select_database(self, database_name):
+        if self.set_database_path(database_name):
+            self.preload_models()
+
     def set_video_path(self, video_path: str):
+        '''
+        output: bool - whether the video is loaded
+        '''
         logger.info(f"Set video path:\n\"{video_path}\"")
         self.cur_process = f"Selected video: \"{os.path.basename(video_path)}\""
         self.cur_progress = 0
@@ -419,20 +634,27 @@ class Backend():
             self.cur_progress = 0
             self.total_progress = 0
             self.update_progress()
+            return False
+        return True
 
     def set_database_path(self, database_name):
+        '''
+        output: bool - whether the database is set
+        '''
         self.database_name = None
         if not isinstance(database_name, str):
             self.raise_error("Invalid database name.")
-            return
+            return False
         
         if not os.path.exists(os.path.join(config['STORE_DIR']['DATABASE_ROOT'], database_name)):
             self.raise_error("Database not found.")
-            return
+            return False
         
-        self.fdm = FaceDatabaseManager(os.path.join(config['STORE_DIR']['DATABASE_ROOT'], database_name))
+        database_root = os.path.join(config['STORE_DIR']['DATABASE_ROOT'], database_name)
+        self.fdm = FaceDatabaseManager(database_root, ann_index=IVFIndex(), embedding_store=EmbeddingStore(database_root))
         self.database_name = database_name
         logger.info(f"Set database path:\"{database_name}\"")
+        return True
 
     def create_database(self, database_name):
         if not isinstance(database_name, str):
@@ -696,6 +918,10 @@ class Backend():
 
     def terminateProcess(self):
         self.running = False
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.sm is not None and not self.testing: # a test run may share the ScriptManager of speculative transcription
+            self.sm.cancel_transcription()
         
         
         time.sleep(1)
@@ -714,6 +940,18 @@ class Backend():
             logger.warning("No record to save")
             return
         
+        # face processing is done, wait for the transcription running beside it
+        self.cur_process = "Transcribing..."
+        self.cur_progress = 0
+        self.total_progress = 0
+        self.update_progress()
+        
+        def transcription_progress(progress, total):
+            self.cur_progress = progress
+            self.total_progress = total
+            self.update_progress()
+        self.sm.wait_transcription(transcription_progress)
+        
         script_result = self.sm.get_result()
         if script_result is None:
             self.record.set_script(script_result)
@@ -725,4 +963,5 @@ class Backend():
         self.record.export()
 
 if __name__ == '__main__':
+    init_logger()
     Backend()
@@ -0,0 +1,48 @@
+import time
+import numpy as np
+
+from backend.AnnIndex import IVFIndex
+
+# synthetic database: members with several embeddings scattered around their own direction
+MEMBER_NUM = 2000
+EMBEDDING_PER_MEMBER = 15
+QUERY_NUM = 500
+NOISE = 0.06
+DIM = 512
+
+def normalize(x):
+    return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+def exact_search(matrix, labels, queries):
+    scores = np.dot(queries, matrix.T)
+    best_rows = np.argmax(scores, axis=1)
+    return labels[best_rows]
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    centers = normalize(rng.standard_normal((MEMBER_NUM, DIM)))
+    labels = np.repeat(np.arange(MEMBER_NUM, dtype=np.int32), EMBEDDING_PER_MEMBER)
+    matrix = normalize(centers[labels] + rng.standard_normal((len(labels), DIM)) * NOISE).astype(np.float32)
+    query_members = rng.integers(0, MEMBER_NUM, QUERY_NUM)
+    queries = normalize(centers[query_members] + rng.standard_normal((QUERY_NUM, DIM)) * NOISE).astype(np.float32)
+    print(f'database: {MEMBER_NUM} members, {len(matrix)} embeddings, {QUERY_NUM} queries')
+
+    build_time = time.monotonic()
+    index = IVFIndex(dim=DIM)
+    index.add(matrix, labels)
+    index.train(matrix)
+    build_time = time.monotonic() - build_time
+    print(f'index build time: {build_time:.2f}s, lists: {len(index.centroids)}')
+
+    # exact search, one query at a time like one face per get_name call
+    exact_time = time.monotonic()
+    truth = np.concatenate([exact_search(matrix, labels, queries[i:i+1]) for i in range(QUERY_NUM)])
+    exact_time = (time.monotonic() - exact_time) / QUERY_NUM
+    print(f'exact      recall: 1.000, latency: {exact_time*1000:.3f} ms/query')
+
+    for n_probe in [1, 2, 4, 8, 16, 32]:
+        ann_time = time.monotonic()
+        found = np.concatenate([index.search(queries[i:i+1], n_probe=n_probe)[0] for i in range(QUERY_NUM)])
+        ann_time = (time.monotonic() - ann_time) / QUERY_NUM
+        recall = np.mean(found == truth)
+        print(f'n_probe={n_probe:<3} recall: {recall:.3f}, latency: {ann_time*1000:.3f} ms/query')
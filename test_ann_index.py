@@ -0,0 +1,84 @@
+import numpy as np
+
+from backend.AnnIndex import IVFIndex, MIN_TRAIN_SIZE, RETRAIN_GROWTH
+
+DIM = 64
+MEMBER_NUM = 200
+EMBEDDING_PER_MEMBER = 10
+NOISE = 0.1
+
+def normalize(x):
+    return x / np.linalg.norm(x, axis=-1, keepdims=True)
+
+def exact_search(matrix, labels, queries):
+    return labels[np.argmax(np.dot(queries, matrix.T), axis=1)]
+
+def members(rng):
+    # members with several embeddings scattered around their own direction, one query for each member
+    centers = normalize(rng.standard_normal((MEMBER_NUM, DIM)))
+    labels = np.repeat(np.arange(MEMBER_NUM, dtype=np.int32), EMBEDDING_PER_MEMBER)
+    matrix = normalize(centers[labels] + rng.standard_normal((len(labels), DIM)) * NOISE).astype(np.float32)
+    queries = normalize(centers + rng.standard_normal((MEMBER_NUM, DIM)) * NOISE).astype(np.float32)
+    return matrix, labels, queries
+
+def trained_index(matrix, labels):
+    index = IVFIndex(dim=DIM)
+    index.add(matrix, labels)
+    index.train(matrix)
+    return index
+
+def test_untrained_is_exact():
+    rng = np.random.default_rng(0)
+    matrix, labels, queries = members(rng)
+    index = IVFIndex(dim=DIM)
+    index.add(matrix, labels)
+    assert not index.is_trained()
+    found, scores = index.search(queries)
+    assert np.array_equal(found, exact_search(matrix, labels, queries))
+    assert np.allclose(scores, np.max(np.dot(queries, matrix.T), axis=1), atol=1e-5)
+
+def test_needs_training():
+    index = IVFIndex(dim=DIM)
+    assert not index.needs_training(MIN_TRAIN_SIZE - 1)
+    assert index.needs_training(MIN_TRAIN_SIZE)
+    rng = np.random.default_rng(1)
+    matrix, labels, _ = members(rng)
+    index = trained_index(matrix, labels)
+    assert not index.needs_training(len(matrix) * RETRAIN_GROWTH)
+    assert index.needs_training(len(matrix) * RETRAIN_GROWTH + 1)
+
+def test_recall_against_exact_search():
+    rng = np.random.default_rng(2)
+    matrix, labels, queries = members(rng)
+    index = trained_index(matrix, labels)
+    assert index.size() == len(matrix)
+    truth = exact_search(matrix, labels, queries)
+    assert np.mean(index.search(queries, n_probe=4)[0] == truth) >= 0.9
+    # scoring every list is exact search
+    assert np.array_equal(index.search(queries, n_probe=len(index.centroids))[0], truth)
+
+def test_remove_label():
+    rng = np.random.default_rng(3)
+    matrix, labels, queries = members(rng)
+    index = trained_index(matrix, labels)
+    index.remove_label(0)
+    assert index.size() == len(matrix) - EMBEDDING_PER_MEMBER
+    keep = labels != 0
+    found = index.search(queries, n_probe=len(index.centroids))[0]
+    assert np.array_equal(found, exact_search(matrix[keep], labels[keep], queries))
+
+def test_save_and_load(tmp_path):
+    rng = np.random.default_rng(4)
+    matrix, labels, queries = members(rng)
+    index = trained_index(matrix, labels)
+    path = str(tmp_path / 'index.npz')
+    index.save(path)
+
+    loaded = IVFIndex(dim=DIM)
+    assert loaded.load(path)
+    assert np.array_equal(loaded.centroids, index.centroids)
+    # only the centroids are saved, the lists are filled again
+    assert loaded.size() == 0
+    loaded.add(matrix, labels)
+    assert np.array_equal(loaded.search(queries)[0], index.search(queries)[0])
+    assert not IVFIndex(dim=DIM).load(str(tmp_path / 'missing.npz'))
@@ -0,0 +1,121 @@
+import glob
+import json
+import os
+import numpy as np
+
+from backend.EmbeddingStore import EmbeddingStore, STORE_DATA_FILE, STORE_INDEX_FILE
+
+DIM = 512
+
+def random_embeddings(rng, count):
+    embeddings = rng.standard_normal((count, DIM)).astype(np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+def reloaded(root):
+    store = EmbeddingStore(str(root))
+    assert store.load()
+    return store
+
+def test_append_and_reload(tmp_path):
+    rng = np.random.default_rng(0)
+    a = random_embeddings(rng, 2)
+    b = random_embeddings(rng, 3)
+    store = EmbeddingStore(str(tmp_path))
+    assert not store.load()
+    store.append('a', a, ['0.png', '1.png'])
+    store.append('b', b)
+
+    store = reloaded(tmp_path)
+    matrix, names, images = store.get_rows()
+    assert isinstance(matrix, np.memmap)
+    assert np.array_equal(matrix, np.concatenate([a, b]))
+    assert names == ['a', 'a', 'b', 'b', 'b']
+    assert images == ['0.png', '1.png', '', '', '']
+    embeddings, image_ids = store.get_member('a')
+    assert np.array_equal(embeddings, a)
+    assert image_ids == ['0.png', '1.png']
+
+def test_remove_and_rename(tmp_path):
+    rng = np.random.default_rng(1)
+    a = random_embeddings(rng, 2)
+    b = random_embeddings(rng, 3)
+    store = EmbeddingStore(str(tmp_path))
+    store.append('a', a)
+    store.append('b', b)
+    store.remove('a')
+    store.rename('b', 'c')
+
+    store = reloaded(tmp_path)
+    assert store.get_names() == {'c'}
+    assert store.dead_count() == 2
+    matrix, names, _ = store.get_rows()
+    assert np.array_equal(matrix, b)
+    assert names == ['c', 'c', 'c']
+    assert store.get_member('b')[0] is None
+
+def test_compact(tmp_path):
+    rng = np.random.default_rng(2)
+    a = random_embeddings(rng, 4)
+    b = random_embeddings(rng, 2)
+    c = random_embeddings(rng, 1)
+    store = EmbeddingStore(str(tmp_path))
+    store.append('a', a)
+    store.append('b', b)
+    store.append('a', c)
+    store.replace('b', b[:1])
+    store.compact()
+
+    assert store.generation == 1
+    assert glob.glob(os.path.join(str(tmp_path), STORE_DATA_FILE.format('*'))) == [store.data_path]
+    store = reloaded(tmp_path)
+    assert store.dead_count() == 0
+    assert np.array_equal(store.get_member('a')[0], np.concatenate([a, c]))
+    assert np.array_equal(store.get_member('b')[0], b[:1])
+    # appending after compaction goes on in the new file
+    store.append('d', c)
+    assert np.array_equal(reloaded(tmp_path).get_member('d')[0], c)
+
+def test_compact_if_needed(tmp_path):
+    rng = np.random.default_rng(3)
+    store = EmbeddingStore(str(tmp_path))
+    store.append('a', random_embeddings(rng, 3))
+    store.append('b', random_embeddings(rng, 3))
+    store.remove('a')
+    store.compact_if_needed()
+    assert store.generation == 1
+    assert store.dead_count() == 0
+
+def test_append_while_mapped(tmp_path):
+    rng = np.random.default_rng(4)
+    a = random_embeddings(rng, 2)
+    b = random_embeddings(rng, 2)
+    store = EmbeddingStore(str(tmp_path))
+    store.append('a', a)
+    mapped, _, _ = store.get_rows()
+    store.append('b', b)
+    assert np.array_equal(mapped, a)
+    assert np.array_equal(reloaded(tmp_path).get_rows()[0], np.concatenate([a, b]))
+
+def test_recover_interrupted_writes(tmp_path):
+    rng = np.random.default_rng(5)
+    a = random_embeddings(rng, 2)
+    b = random_embeddings(rng, 2)
+    store = EmbeddingStore(str(tmp_path))
+    store.append('a', a)
+    # rows written without their index line, and an index line cut in the middle
+    with open(store.data_path, 'ab') as f:
+        f.write(b'\x01' * (DIM * 4 + 10))
+    with open(os.path.join(str(tmp_path), STORE_INDEX_FILE), 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'op': 'add', 'name': 'x', 'images': ['']})[:10])
+
+    store = reloaded(tmp_path)
+    assert store.get_names() == {'a'}
+    store.append('b', b)
+
+    store = reloaded(tmp_path)
+    assert store.get_names() == {'a', 'b'}
+    assert np.array_equal(store.get_member('a')[0], a)
+    assert np.array_equal(store.get_member('b')[0], b)
+    assert np.array_equal(store.get_rows()[0], np.concatenate([a, b]))
+    store.compact()
+    assert np.array_equal(reloaded(tmp_path).get_rows()[0], np.concatenate([a, b]))
@@ -0,0 +1,72 @@
+import numpy as np
+
+from backend.FaceTracker import FaceTracker, iou_matrix, move_points, MAX_MISSES
+
+def test_iou_matrix():
+    ious = iou_matrix([[0, 0, 10, 10]], [[0, 0, 10, 10], [5, 0, 15, 10], [20, 20, 30, 30]])
+    assert np.allclose(ious, [[1.0, 1 / 3, 0.0]])
+
+def test_move_points():
+    points = move_points([[2, 2], [8, 5]], [0, 0, 10, 10], [10, 20, 30, 40])
+    assert np.allclose(points, [[14, 24], [26, 30]])
+
+def test_match_keeps_track_ids():
+    tracker = FaceTracker()
+    first = tracker.update([[0, 0, 10, 10], [50, 50, 60, 60]], 0)
+    # both faces moved a little, listed in the other order
+    second = tracker.update([[52, 51, 62, 61], [1, 0, 11, 10]], 1)
+    assert second == [first[1], first[0]]
+    # a face far from every track starts a new one
+    third = tracker.update([[2, 0, 12, 10], [54, 52, 64, 62], [100, 100, 110, 110]], 2)
+    assert third[:2] == [first[0], first[1]]
+    assert third[2] not in first
+
+def test_predict_follows_velocity():
+    tracker = FaceTracker()
+    track_id, = tracker.update([[0, 0, 10, 10]], 0)
+    tracker.update([[4, 0, 14, 10]], 2)
+    tracker.set_landmark(track_id, np.array([[5, 5]], dtype=np.float32))
+    (predicted_id, bbox, landmark), = tracker.predict(3)
+    assert predicted_id == track_id
+    assert bbox[0] > 4 and np.isclose(bbox[2] - bbox[0], 10)
+    # the landmark moves with the predicted bbox
+    assert np.allclose(landmark, [[bbox[0] + 1, 5]])
+    # a fast move is still matched to the predicted position
+    assert tracker.update([[6, 0, 16, 10]], 4) == [track_id]
+
+def test_missed_track_is_aged_out():
+    tracker = FaceTracker()
+    track_id, = tracker.update([[0, 0, 10, 10]], 0)
+    for frame_idx in range(1, MAX_MISSES + 1):
+        tracker.update([], frame_idx)
+        assert track_id in tracker.tracks
+        # a track not found in the last detection is not predicted
+        assert tracker.predict(frame_idx) == []
+    # found again before it is dropped
+    assert tracker.update([[0, 0, 10, 10]], MAX_MISSES + 1) == [track_id]
+
+    for frame_idx in range(MAX_MISSES + 2, 2 * MAX_MISSES + 3):
+        tracker.update([], frame_idx)
+    assert track_id not in tracker.tracks
+    assert tracker.update([[0, 0, 10, 10]], 2 * MAX_MISSES + 3) != [track_id]
+
+def test_name_is_cached_until_drift():
+    tracker = FaceTracker()
+    track_id, = tracker.update([[0, 0, 10, 10]], 0)
+    assert tracker.needs_recognition(track_id)
+    embedding = np.zeros((512,), dtype=np.float32)
+    embedding[0] = 1
+    tracker.observe(track_id, embedding, 0.8)
+    tracker.set_name(track_id, 'a')
+    tracker.update([[0, 0, 10, 10]], 1)
+    tracker.observe(track_id, embedding, 0.8)
+    assert not tracker.needs_recognition(track_id)
+    assert tracker.get_name(track_id) == 'a'
+
+    # the face turns into someone else
+    other = np.zeros((512,), dtype=np.float32)
+    other[1] = 1
+    for frame_idx in range(2, 20):
+        tracker.update([[0, 0, 10, 10]], frame_idx)
+        tracker.observe(track_id, other, 0.8)
+    assert tracker.needs_recognition(track_id)
@@ -0,0 +1,81 @@
+import pytest
+import random
+
+pytest.importorskip('whisper')
+
+from backend.ScriptManager import ScriptManager, SAMPLE_RATE, _split_overlapping, _stitch_segments
+
+def segment(start, end, text):
+    return {'start': start, 'end': end, 'text': text}
+
+def test_overlapping_chunks_cover_audio():
+    chunks = _split_overlapping(150 * SAMPLE_RATE, chunk_seconds=60, overlap_seconds=5)
+    assert chunks[0][0] == 0 and chunks[-1][1] == 150 * SAMPLE_RATE
+    for (_, end), (start, _) in zip(chunks[:-1], chunks[1:]):
+        assert end - start == 5 * SAMPLE_RATE
+
+def test_stitch_keeps_each_segment_once():
+    # chunks of 0-60s, 55-115s and 110-120s, the overlaps split at 57.5s and 112.5s
+    chunks = [[chunk] for chunk in _split_overlapping(120 * SAMPLE_RATE, chunk_seconds=60, overlap_seconds=5)]
+    assert len(chunks) == 3
+    chunk_segments = [
+        [segment(0, 10, 'a'), segment(52, 56, 'b'), segment(56.5, 59.5, 'c')],
+        [segment(55, 56, 'b tail'), segment(56.5, 59.5, 'c'), segment(70, 80, 'd'), segment(112, 114, 'e')],
+        [segment(112, 114, 'e'), segment(115, 119, 'f')],
+    ]
+    result = _stitch_segments(chunks, chunk_segments)
+    assert [s['text'] for s in result] == ['a', 'b', 'c', 'd', 'e', 'f']
+    assert result[2]['start'] == 56.5
+
+def test_stitch_drops_line_recognized_by_both_chunks():
+    # the same line found a little shifted in both chunks, on either side of the middle of the overlap
+    chunks = [[chunk] for chunk in _split_overlapping(100 * SAMPLE_RATE, chunk_seconds=60, overlap_seconds=5)]
+    chunk_segments = [
+        [segment(50, 55, 'a'), segment(56, 58.4, 'same')],
+        [segment(56.2, 58.9, 'same'), segment(60, 65, 'b')],
+    ]
+    result = _stitch_segments(chunks, chunk_segments)
+    assert [s['text'] for s in result] == ['a', 'same', 'b']
+
+def test_stitch_single_chunk():
+    chunks = [[(0, 30 * SAMPLE_RATE)]]
+    segments = [segment(0, 10, 'a'), segment(10, 20, 'b')]
+    assert _stitch_segments(chunks, [segments]) == segments
+
+def indexed_manager(segments):
+    sm = ScriptManager()
+    sm.result = segments
+    return sm
+
+def test_range_queries_match_linear_scan():
+    rng = random.Random(0)
+    # unsorted, overlapping, and one long segment covering many others
+    segments = [segment(start, start + rng.uniform(0.5, 8), str(i)) for i, start in enumerate(rng.sample(range(0, 600), 120))]
+    segments.append(segment(100.5, 400.5, 'long'))
+    sm = indexed_manager(segments)
+    for _ in range(300):
+        _from = rng.uniform(-10, 620)
+        _to = _from + rng.uniform(0, 30)
+        expected = sorted([s for s in segments if s['end'] >= _from and s['start'] <= _to], key=lambda s: s['start'])
+        assert sm.get_scripts_in_range(_from, _to) == expected
+        assert sm.script_detected_in(_from, _to) == (len(expected) > 0)
+
+def test_script_by_time():
+    sm = indexed_manager([segment(5, 8, 'b'), segment(0, 20, 'long'), segment(10, 12, 'c'), segment(30, 31, 'd')])
+    assert sm.get_script_by_time(6) == 'b'
+    # the latest started segment covering the time
+    assert sm.get_script_by_time(11) == 'c'
+    assert sm.get_script_by_time(15) == 'long'
+    assert sm.get_script_by_time(8) == 'b'
+    assert sm.get_script_by_time(25) == ''
+    assert sm.get_script_by_time(31) == 'd'
+    assert sm.get_script_by_time(-1) == ''
+
+def test_queries_without_result():
+    sm = ScriptManager()
+    assert sm.get_scripts_in_range(0, 10) == []
+    assert not sm.script_detected_in(0, 10)
+    assert sm.get_script_by_time(0) == ''
+    sm.result = []
+    assert sm.get_scripts_in_range(0, 10) == []
+    assert sm.get_scripts_in_range(10, 0) == []
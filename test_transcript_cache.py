@@ -0,0 +1,71 @@
+import os
+import time
+
+from backend.TranscriptCache import TranscriptCache, video_fingerprint
+
+SEGMENTS = [{'start': 0.0, 'end': 1.5, 'text': 'hello'}]
+
+def entry_paths(cache):
+    return sorted([os.path.join(cache.cache_dir, name) for name in os.listdir(cache.cache_dir) if name.endswith('.json')])
+
+def set_age(cache, fingerprint, days):
+    path = cache._entry_path(fingerprint, 'small', 'zh', False, 'chunked')
+    mtime = time.time() - days * 24 * 60 * 60
+    os.utime(path, (mtime, mtime))
+
+def test_put_and_get(tmp_path):
+    cache = TranscriptCache(str(tmp_path))
+    assert cache.get('f', 'small', 'zh', False, 'chunked') is None
+    cache.put('f', 'small', 'zh', False, 'chunked', SEGMENTS)
+    assert cache.get('f', 'small', 'zh', False, 'chunked') == SEGMENTS
+    # results of other settings are separate entries
+    assert cache.get('f', 'base', 'zh', False, 'chunked') is None
+    assert cache.get('f', 'small', 'en', False, 'chunked') is None
+    assert cache.get('f', 'small', 'zh', True, 'chunked') is None
+    assert cache.get('f', 'small', 'zh', False, 'parallel') is None
+
+def test_broken_entry_is_dropped(tmp_path):
+    cache = TranscriptCache(str(tmp_path))
+    cache.put('f', 'small', 'zh', False, 'chunked', SEGMENTS)
+    path, = entry_paths(cache)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"segm')
+    assert cache.get('f', 'small', 'zh', False, 'chunked') is None
+    assert entry_paths(cache) == []
+
+def test_evict_by_age(tmp_path):
+    cache = TranscriptCache(str(tmp_path), max_days=30)
+    cache.put('old', 'small', 'zh', False, 'chunked', SEGMENTS)
+    cache.put('new', 'small', 'zh', False, 'chunked', SEGMENTS)
+    set_age(cache, 'old', 31)
+    set_age(cache, 'new', 29)
+    cache.evict()
+    assert cache.get('old', 'small', 'zh', False, 'chunked') is None
+    assert cache.get('new', 'small', 'zh', False, 'chunked') == SEGMENTS
+
+def test_evict_least_recently_used_by_size(tmp_path):
+    cache = TranscriptCache(str(tmp_path))
+    for i, fingerprint in enumerate(['a', 'b', 'c']):
+        cache.put(fingerprint, 'small', 'zh', False, 'chunked', SEGMENTS)
+        set_age(cache, fingerprint, 3 - i)
+    # a is read, so b is the least recently used
+    assert cache.get('a', 'small', 'zh', False, 'chunked') == SEGMENTS
+    cache.max_bytes = sum([os.path.getsize(path) for path in entry_paths(cache)]) - 1
+    cache.evict()
+    assert cache.get('b', 'small', 'zh', False, 'chunked') is None
+    assert cache.get('a', 'small', 'zh', False, 'chunked') == SEGMENTS
+    assert cache.get('c', 'small', 'zh', False, 'chunked') == SEGMENTS
+
+def test_video_fingerprint(tmp_path):
+    path = str(tmp_path / 'video.mp4')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(3 * 1024 * 1024))
+    fingerprint = video_fingerprint(path)
+    assert video_fingerprint(path) == fingerprint
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(b'\x00' if last != b'\x00' else b'\x01')
+    assert os.path.getsize(path) == 3 * 1024 * 1024
+    assert video_fingerprint(path) != fingerprint